@@ -1,26 +1,54 @@
 # coding: utf-8
 #!/usr/bin/python3
 
+import time
+_startup_time = time.perf_counter()     # 起動時間の計測用
+
 import requests
 import yaml
 
-import ccxt
+# ccxt は読み込みに時間とメモリを使うので、設定されている取引所で必要になった時に読み込む (ccxt_api)
 
 #import libs.ccxt    #<---------BTCMEX対応のため neo_duelbotのlibs/ccxt 以下と libs/utils をカレントフォルダに置くと使えます
 
+import argparse
+from array import array
+import atexit
+import bisect
 import calendar
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
 import copy
-from datetime import datetime,timedelta
+import gzip
+from datetime import datetime,timedelta,timezone
 import hashlib
+import heapq
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import hmac
 import json
+import math
+import multiprocessing
+import os
+import queue
 import re
+import sys
+import threading
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
 from requests import Request, Session
-from requests.exceptions import HTTPError
-import time
+from requests.exceptions import HTTPError, Timeout
 import traceback
+from types import MappingProxyType
 import urllib.parse
+import zlib
+
+# 複数のプロセスが同じ local_store に書き込む時のファイルロック
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+    import msvcrt
 
 from logging import getLogger, ERROR, WARNING, INFO, DEBUG, StreamHandler, Formatter
 def setup_logger():
@@ -32,55 +60,840 @@ def setup_logger():
     logger.addHandler(handler)
     return logger
 
+class perf_monitor():
+    # 通信やDB書き込みの所要時間を、取引所(スレッド毎に設定するグループ)とサイクル毎に集計する
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__spans = {}
+        self.__counters = {}
+        self.metrics = ''       # 前回サイクルの集計 (Prometheusのテキスト形式)
+        self.tags = {}          # 全ての点とラベルに付けるタグ (シャードのプロセスでは shard)
+        self.children = {}      # シャードのプロセスから届いた集計 (コーディネーターのエンドポイントで一緒に返す)
+
+    def set_group(self, group):
+        self.__local.group = group
+
+    def add(self, name, elapsed, error=False, group=None):
+        key = (group or getattr(self.__local, 'group', 'background'), name)
+        with self.__lock:
+            span = self.__spans.setdefault(key, [0, 0.0, 0.0, 0])
+            span[0] += 1
+            span[1] += elapsed
+            span[2] = max(span[2], elapsed)
+            span[3] += int(error)
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name,0)+n
+
+    def end_cycle(self, db, cycle_time):
+        # サイクルの集計を profitgraph_perf に書き込んで次のサイクルの集計を始める
+        with self.__lock:
+            spans, self.__spans = self.__spans, {}
+            counters, self.__counters = self.__counters, {}
+
+        # Prometheusの形式では同じ名前の値をまとめて並べる
+        # シャード毎のプロセスの点が同じシリーズで上書きし合わないようにタグを付ける
+        families = dict([(name,[]) for name in ('count', 'seconds', 'seconds_max', 'errors')])
+        for (group,name),(count,elapsed,elapsed_max,errors) in sorted(spans.items()):
+            db.write( measurement="profitgraph_perf", tags=dict(self.tags, group=group, span=name),
+                      count=count, elapsed=float(elapsed), elapsed_max=float(elapsed_max), errors=errors)
+            labels = self.__labels(group=group, span=name)
+            for family,val in zip(('count', 'seconds', 'seconds_max', 'errors'), (count, elapsed, elapsed_max, errors)):
+                families[family].append('profitgraph_span_{}{} {}'.format(family, labels, val))
+        db.write( measurement="profitgraph_perf", tags=dict(self.tags, group='cycle', span='cycle'),
+                  count=1, elapsed=float(cycle_time), **counters )
+        metrics = ['profitgraph_cycle_seconds{} {}'.format(self.__labels(), cycle_time)]
+        for lines in families.values():
+            metrics += lines
+        metrics += ['profitgraph_{}{} {}'.format(key, self.__labels(), val) for key,val in sorted(counters.items())]
+        self.metrics = '\n'.join(metrics)+'\n'
+
+    def __labels(self, **labels):
+        labels = dict(self.tags, **labels)
+        if not labels :
+            return ''
+        return '{{{}}}'.format(','.join('{}="{}"'.format(k, str(v).replace('\\','\\\\').replace('"','\\"')) for k,v in labels.items()))
+
+    def exposition(self):
+        # 自分とシャードのプロセスの集計を合わせる (Prometheusの形式では同じ名前の値をまとめて並べる)
+        lines = [line for text in [self.metrics]+[self.children[k] for k in sorted(self.children)] for line in text.splitlines() if line]
+        lines.sort(key=lambda line: re.match(r'[^{\s]*', line).group(0))
+        return ''.join(line+'\n' for line in lines)
+
+    def start_http_server(self, port):
+        # Prometheus から読み込めるように前回サイクルの集計を返す
+        monitor = self
+        class metrics_handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = monitor.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        httpd = ThreadingHTTPServer(('', port), metrics_handler)
+        threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+
+perf = perf_monitor()
+
+
+class http_session(Session):
+    # 接続を使い回す (keep-alive) セッション。タイムアウトが指定されていない呼び出しには既定値を使う
+    # hedge_after 秒を指定すると、GETの応答がそれまでに無ければ同じリクエストをもう1つ送って早い方を使う
+    def __init__(self, timeout, pool_size=10, hedge_after=None, redirect=True):
+        super().__init__()
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.redirect = redirect
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def send(self, request, **kwargs):
+        timeout = kwargs.get('timeout') or self.timeout
+        # 残高取得の締め切りが決まっていれば、それを超えないようにタイムアウトを縮める
+        deadline = getattr(_call_deadline, 'time', None)
+        if deadline :
+            remaining = deadline-time.time()
+            if remaining <= 0 :
+                raise Timeout("Deadline exceeded before sending {}".format(urllib.parse.urlsplit(request.url).path))
+            timeout = tuple(min(t, remaining) for t in timeout) if isinstance(timeout, (tuple, list)) else min(timeout, remaining)
+        kwargs['timeout'] = timeout
+
+        url = urllib.parse.urlsplit(request.url)
+        if http_redirect and self.redirect :
+            request.url = '{}/{}{}'.format(http_redirect, url.netloc, url.path+('?'+url.query if url.query else ''))
+        start = time.perf_counter()
+        try:
+            if self.hedge_after and request.method=='GET' :
+                response = self.__hedged_send(request, **kwargs)
+            else:
+                response = super().send(request, **kwargs)
+        except Exception:
+            perf.add(url.netloc+url.path, time.perf_counter()-start, error=True)
+            raise
+        perf.add(url.netloc+url.path, time.perf_counter()-start, error=(response.status_code>=400))
+        if http_record :
+            http_record(request, response)
+        return response
+
+    def __hedged_send(self, request, **kwargs):
+        # 状態を変えないGETだけが対象 (後から返った方の応答は捨てる)
+        send = super().send
+        futures = [_hedge_executor.submit(send, request, **kwargs)]
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done :
+            perf.count('hedged_requests')
+            futures.append(_hedge_executor.submit(send, request.copy(), **kwargs))
+        error = None
+        while futures :
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None :
+                    return future.result()
+                error = future.exception()
+        raise error
+
+# (接続タイムアウト, 読み込みタイムアウト) 秒
+session_timeout = (5, 15)
+# ベンチマーク用の記録/再生フック (ProfitGraph_bench.py から設定する)
+http_record = None      # (request, response) を受け取って記録する関数
+http_redirect = None    # 'http://127.0.0.1:port' を指定すると全ての通信をスタブサーバーへ送る
+# GETの応答を待つ秒数 (これを過ぎたら同じリクエストをもう1つ送る。None なら送らない)
+http_hedge_after = None
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+# 残高取得中のスレッドの締め切り (time.time()の値)
+_call_deadline = threading.local()
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(host):
+    # ホスト毎に1つのセッションを全スレッドで共有する
+    with _sessions_lock:
+        if host not in _sessions :
+            _sessions[host] = http_session(session_timeout, hedge_after=http_hedge_after)
+        return _sessions[host]
+
+def http_get(url, **kwargs):
+    return get_session(urllib.parse.urlparse(url).netloc).get(url, **kwargs)
+
+
+def _escape(text, chars):
+    text = str(text).replace('\\', '\\\\')
+    for c in chars:
+        text = text.replace(c, '\\'+c)
+    return text
+
+_series_keys = {}
+
+def line_protocol(point):
+    # {"measurement", "tags", "time"(ms), "fields"} の辞書を InfluxDB のラインプロトコルに変換する
+    # (measurement とタグの部分は取引所毎に同じなので一度作ったものを使い回す)
+    tags = tuple(sorted((point.get('tags') or {}).items()))
+    key = _series_keys.get((point['measurement'], tags))
+    if key is None :
+        key = _escape(point['measurement'], ', ')
+        for k,v in tags:
+            key += ',{}={}'.format(_escape(k, ',= '), _escape(v, ',= '))
+        _series_keys[(point['measurement'], tags)] = key
+    fields = []
+    for k,v in point['fields'].items():
+        # 値の無いフィールドと、InfluxDBが受け付けない nan/inf は書き込まない (1つでもあるとまとめて書き込んだ全体が拒否される)
+        if v is None or (isinstance(v, float) and not math.isfinite(v)) :
+            continue
+        if isinstance(v, bool):
+            v = 'true' if v else 'false'
+        elif isinstance(v, int):
+            v = '{}i'.format(v)
+        elif isinstance(v, float):
+            v = repr(v)
+        else:
+            v = '"{}"'.format(str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        fields.append('{}={}'.format(_escape(k, ',= '), v))
+    return '{} {} {}'.format(key, ','.join(fields), point['time'])
+
+
+def _split_unescaped(text, sep, maxsplit=-1):
+    # バックスラッシュでエスケープされたものと "" の中のものを除いて sep で区切る
+    parts = []
+    start = i = 0
+    quoted = False
+    while i < len(text):
+        c = text[i]
+        if c=='\\' :
+            i += 2
+            continue
+        if c=='"' :
+            quoted = not quoted
+        elif c==sep and not quoted and (maxsplit<0 or len(parts)<maxsplit) :
+            parts.append(text[start:i])
+            start = i+1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+def _unescape(text):
+    return re.sub(r'\\(.)', r'\1', text)
+
+def parse_line_protocol(line):
+    # line_protocol() で作った行を (measurement, タグの辞書, フィールドの辞書, 時刻) に戻す
+    key, fields, timestamp = _split_unescaped(line, ' ', 2)
+    key = _split_unescaped(key, ',')
+    tags = dict([[_unescape(t) for t in _split_unescaped(tag, '=', 1)] for tag in key[1:]])
+    values = {}
+    for field in _split_unescaped(fields, ','):
+        k,v = _split_unescaped(field, '=', 1)
+        if v.startswith('"') :
+            v = _unescape(v[1:-1])
+        elif v in ('true', 'false') :
+            v = (v=='true')
+        elif v.endswith('i') :
+            v = int(v[:-1])
+        else:
+            v = float(v)
+        values[_unescape(k)] = v
+    return _unescape(key[0]), tags, values, int(timestamp)
+
+
+def _parse_time(text):
+    # 取引所が返すUTCの時刻 ('2020-01-02T03:04:05.678Z' など) をミリ秒に変換する
+    date, _, frac = text.rstrip('Z').partition('.')
+    return calendar.timegm(datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S').timetuple())*1000 + int((frac+'000')[:3])
+
+def _parse_date(text):
+    # コマンドラインで指定する日付 ('2020-01-02') をUTCのその日の0時にする (PCのタイムゾーンによらない)
+    return datetime.strptime(text, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+def _max_rss_mb():
+    # このプロセスの最大メモリ使用量(MB) (resource は POSIX にしか無いので、Windows では None)
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+class write_spool():
+    # InfluxDBに書き込めない間、ポイントをラインプロトコルでファイルに追記しておく
+    # (segment_size毎にファイルを分け、合計がmax_sizeを超えたら古いものから捨てる)
+    def __init__(self, logger, directory, segment_size=8*1024*1024, max_size=512*1024*1024):
+        self._logger = logger
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__max_size = max_size
+        self.__file = None
+        os.makedirs(directory, exist_ok=True)
+        self.__segments = sorted(os.path.join(directory,f) for f in os.listdir(directory) if f.startswith('spool-') and f.endswith('.lp'))
+        if self.__segments :
+            self._logger.info("Found {} spooled segments ({:,} bytes)".format(len(self.__segments), self.size()))
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in self.__segments if os.path.exists(f))
+
+    def append(self, lines):
+        if self.__file is None or self.__file.tell() >= self.__segment_size :
+            self.__rotate()
+        # バッチ単位でまとめてfsyncする
+        self.__file.write('\n'.join(lines)+'\n')
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__trim()
+
+    def __rotate(self):
+        if self.__file is not None :
+            self.__file.close()
+        seq = int(os.path.basename(self.__segments[-1])[6:-3])+1 if self.__segments else 0
+        path = os.path.join(self.__directory, 'spool-{:010d}.lp'.format(seq))
+        self.__segments.append(path)
+        self.__file = open(path, 'a', encoding='utf-8')
+
+    def __trim(self):
+        while len(self.__segments)>1 and self.size() > self.__max_size :
+            path = self.__segments.pop(0)
+            self._logger.error("Spool size exceeds {:,} bytes. Drop {}".format(self.__max_size, path))
+            os.remove(path)
+
+    def replay(self, write_lines, chunk_size):
+        # 古いセグメントから順に大きなまとまりで書き込み、書き込めたものから消す
+        # (失敗したら書き込めた分をセグメントから除いて、例外のまま中断する。次回は続きから書き込む)
+        if self.__file is not None :
+            self.__file.close()
+            self.__file = None
+        count = 0
+        while self.__segments :
+            path = self.__segments[0]
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+            # 追記の途中で落ちた場合の最後の不完全な行は捨てる (InfluxDBにまとめて拒否されないように)
+            if lines[-1] :
+                self._logger.error("Drop an incomplete line at the end of {} : {}".format(path, lines[-1]))
+            lines = [line for line in lines[:-1] if line]
+            for i in range(0, len(lines), chunk_size):
+                try:
+                    write_lines(lines[i:i+chunk_size])
+                except Exception:
+                    if i :
+                        self.__rewrite(path, lines[i:])
+                    raise
+            count += len(lines)
+            os.remove(path)
+            self.__segments.pop(0)
+        return count
+
+    def __rewrite(self, path, lines):
+        tmp_file = path+'.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+
+class query_result():
+    # InfluxQL の問い合わせ結果 (influxdb パッケージの ResultSet のうち使っている get_points() と items() だけ)
+    def __init__(self, response):
+        self.__series = []
+        for result in response.get('results', []):
+            if 'error' in result :
+                raise ValueError(result['error'])
+            self.__series += result.get('series', [])
+
+    def items(self):
+        return [((series['name'], series.get('tags')), self.__points(series)) for series in self.__series]
+
+    def get_points(self):
+        for series in self.__series:
+            yield from self.__points(series)
+
+    @staticmethod
+    def __points(series):
+        return (dict(zip(series['columns'], values)) for values in series.get('values', []))
+
+
+class influx_client():
+    # InfluxDB の HTTP API へラインプロトコルをgzipで圧縮して直接書き込む
+    #   1.x : /write?db=database
+    #   2.x : /api/v2/write?org=org&bucket=bucket (token で認証)
+    # 問い合わせはどちらも InfluxQL の /query を使う (2.x では bucket に DBRP の対応付けが必要)
+    def __init__(self, url, database='', username=None, password=None, org=None, bucket=None, token=None, compress_level=1):
+        self.__url = url.rstrip('/')
+        self.__compress_level = compress_level
+        # 他の通信とは別の接続を使い回す (ベンチマークのスタブへの転送もしない)
+        self.__session = http_session(session_timeout, redirect=False)
+        if token :
+            self.__session.headers['Authorization'] = 'Token '+token
+        auth = {'u': username, 'p': password} if username else {}
+        if bucket :
+            self.__write_url = self.__url+'/api/v2/write'
+            self.__write_params = {'org': org, 'bucket': bucket, 'precision': 'ms'}
+        else:
+            self.__write_url = self.__url+'/write'
+            self.__write_params = dict(auth, db=database, precision='ms')
+        self.__query_params = dict(auth, db=bucket or database)
+
+    def write_points(self, points, protocol='json', time_precision='ms', batch_size=None):
+        # 時刻は全てミリ秒で書き込む
+        lines = points if protocol=='line' else [line_protocol(point) for point in points]
+        step = batch_size or len(lines) or 1
+        for i in range(0, len(lines), step):
+            body = gzip.compress(('\n'.join(lines[i:i+step])+'\n').encode('utf-8'), compresslevel=self.__compress_level)
+            response = self.__session.post(self.__write_url, params=self.__write_params, data=body,
+                                           headers={'Content-Encoding': 'gzip', 'Content-Type': 'text/plain; charset=utf-8'})
+            response.raise_for_status()
+
+    def query(self, query, epoch=None):
+        # SELECT INTO などもあるので POST で送る
+        params = dict(self.__query_params, q=query)
+        if epoch :
+            params['epoch'] = epoch
+        response = self.__session.post(self.__url+'/query', data=params)
+        response.raise_for_status()
+        return query_result(response.json())
+
+
+class local_store():
+    # InfluxDB を使わない場合の組み込みの保存先 (influx_client と同じ write_points() と query() で使う)
+    #   <directory>/<measurement>/<タグ>/<UTCの日付>/time.bin, <フィールド>.bin
+    #   シリーズ (取引所など) 毎、日毎のフォルダに列毎の配列 (time は int64 のミリ秒, 他は float64。値が無い所は NaN) を追記していく
+    #   time.bin の長さまでが書き込み済みの行 (途中で落ちていたら次の追記の時に他の列の長さを揃える)
+    #   追記は日毎のフォルダの .lock をロックして行う (シャードのプロセスが同じフォルダに書き込んでも壊れないように)
+    # 問い合わせはこのスクリプトと分析用のスクリプトが使う InfluxQL の一部だけに対応する
+    #   show measurements / show tag values from "m" with key = "k" / show field keys from "m"
+    #   select <フィールド | *> [as 別名],... from "m" [where "タグ"='値' and time >= 0ms ...] [order by time [desc]] [limit n]
+    #   select <last|first|mean|sum|min|max|count>(<フィールド | *>) [as 別名],... from "m" [where ...] [group by time(60s[, 1ms]), "タグ"]
+    #   (値の無い期間は fill の指定によらず返さない。同じ時刻の点は InfluxDB と同じく後から書いた値で上書きする。時刻は常にミリ秒)
+    # 文字列のフィールドは保存しない
+    partition = 86400000
+
+    __select = re.compile(r'select\s+(?P<fields>.+?)\s+from\s+"?(?P<measurement>[^"\s]+)"?(?:\s+where\s+(?P<where>.+?))?'
+                          r'(?:\s+group\s+by\s+(?P<group>.+?))?(?:\s+order\s+by\s+time(?:\s+(?P<order>asc|desc))?)?(?:\s+limit\s+(?P<limit>\d+))?\s*;?$', re.I|re.S)
+    __field = re.compile(r'(?:(?P<func>\w+)\(\s*)?(?P<field>\*|"[^"]+"|\w+)\s*\)?(?:\s+as\s+"?(?P<alias>[^"]+)"?)?$', re.I)
+    __time_condition = re.compile(r'time\s*(?P<op>>=|>|<=|<)\s*(?P<value>\d+)(?P<unit>ms|s|u|ns)?$', re.I)
+    __tag_condition = re.compile(r'"?(?P<key>[^"=\s]+)"?\s*=\s*\'(?P<value>[^\']*)\'$')
+    __units = {'ns': 0.000001, 'u': 0.001, 'ms': 1, 's': 1000}
+    aggregates = {
+        'last':  lambda values: max(values, key=lambda v: v[0]),
+        'first': lambda values: min(values, key=lambda v: v[0]),
+        'min':   lambda values: min(values, key=lambda v: v[1]),
+        'max':   lambda values: max(values, key=lambda v: v[1]),
+        'mean':  lambda values: (None, sum(v[1] for v in values)/len(values)),
+        'sum':   lambda values: (None, sum(v[1] for v in values)),
+        'count': lambda values: (None, len(values)),
+    }
+
+    def __init__(self, directory):
+        self.__directory = directory
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def __quote(text):
+        return urllib.parse.quote(text, safe='')
+
+    def __series_dir(self, tags):
+        return ','.join('{}={}'.format(self.__quote(k), self.__quote(v)) for k,v in sorted(tags.items())) or '_'
+
+    @staticmethod
+    def __series_tags(series_dir):
+        return dict([[urllib.parse.unquote(t) for t in tag.split('=',1)] for tag in series_dir.split(',') if '=' in tag])
+
+    def __columns(self, path):
+        return [urllib.parse.unquote(f[:-4]) for f in sorted(os.listdir(path)) if f.endswith('.bin') and f!='time.bin']
+
+    def __column_file(self, path, column):
+        return os.path.join(path, self.__quote(column)+'.bin')
+
+    def write_points(self, points, protocol='json', time_precision='ms', batch_size=None):
+        lines = points if protocol=='line' else [line_protocol(point) for point in points]
+        # シリーズと日毎にまとめて追記する
+        groups = {}
+        for line in lines:
+            measurement, tags, fields, timestamp = parse_line_protocol(line)
+            fields = dict([(k,float(v)) for k,v in fields.items() if not isinstance(v, str)])
+            groups.setdefault((measurement, self.__series_dir(tags), timestamp//self.partition), []).append((timestamp, fields))
+        with self.__lock:
+            for (measurement, series, day),rows in groups.items():
+                self.__append(os.path.join(self.__directory, self.__quote(measurement), series, time.strftime('%Y%m%d', time.gmtime(day*self.partition//1000))), rows)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def __file_lock(path):
+        with open(os.path.join(path, '.lock'), 'a+b') as f:
+            if fcntl :
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl :
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def __append(self, path, rows):
+        os.makedirs(path, exist_ok=True)
+        with self.__file_lock(path):
+            self.__append_locked(path, rows)
+
+    def __append_locked(self, path, rows):
+        time_file = os.path.join(path, 'time.bin')
+        count = os.path.getsize(time_file)//8 if os.path.exists(time_file) else 0
+        columns = set(self.__columns(path))
+        for timestamp, fields in rows:
+            columns.update(fields)
+        for column in columns:
+            file = self.__column_file(path, column)
+            size = os.path.getsize(file)//8 if os.path.exists(file) else 0
+            with open(file, 'ab') as f:
+                # 前回の追記が途中で止まっていた列と新しい列は、time.bin の行数に揃えてから追記する
+                if size > count :
+                    f.truncate(count*8)
+                f.write(array('d', [float('nan')]*(count-min(size,count))+[fields.get(column, float('nan')) for timestamp, fields in rows]).tobytes())
+        with open(time_file, 'ab') as f:
+            f.truncate(count*8)
+            f.write(array('q', [timestamp for timestamp, fields in rows]).tobytes())
+
+    def __read(self, path, start, end):
+        # 1日分の [start, end) の行を 時刻のリストと {列: 値のリスト} で返す (時刻順。同じ時刻の行は1つにまとめる)
+        times = array('q')
+        with open(os.path.join(path, 'time.bin'), 'rb') as f:
+            data = f.read()
+        times.frombytes(data[:len(data)//8*8])
+        count = len(times)
+        columns = {}
+        for column in self.__columns(path):
+            values = array('d')
+            with open(self.__column_file(path, column), 'rb') as f:
+                values.frombytes(f.read(count*8))
+            columns[column] = values
+
+        if any(times[i] >= times[i+1] for i in range(count-1)) :
+            rows = {}
+            for i in sorted(range(count), key=times.__getitem__):
+                row = rows.setdefault(times[i], {})
+                row.update([(column, values[i]) for column,values in columns.items() if values[i]==values[i]])
+            times = sorted(rows)
+            columns = dict([(column, [rows[t].get(column, float('nan')) for t in times]) for column in columns])
+        first = bisect.bisect_left(times, start) if start is not None else 0
+        last = bisect.bisect_left(times, end) if end is not None else len(times)
+        return list(times[first:last]), dict([(column, values[first:last]) for column,values in columns.items()])
+
+    def __series(self, measurement, tag_filter):
+        path = os.path.join(self.__directory, self.__quote(measurement))
+        if not os.path.isdir(path) :
+            return []
+        series = [(os.path.join(path, series_dir), self.__series_tags(series_dir)) for series_dir in sorted(os.listdir(path))]
+        return [(series_path, tags) for series_path,tags in series if all(tags.get(k,'')==v for k,v in tag_filter.items())]
+
+    def __partitions(self, series_path, start, end):
+        for day in sorted(os.listdir(series_path)):
+            day_start = calendar.timegm(time.strptime(day, '%Y%m%d'))*1000
+            if (start is None or day_start+self.partition > start) and (end is None or day_start < end) :
+                yield os.path.join(series_path, day)
+
+    def range(self, measurement, tags=None, start=None, end=None):
+        # シリーズ毎の [start, end) の点を (タグ, 時刻のリスト, {列: 値のリスト}) で返す
+        for series_path, series_tags in self.__series(measurement, tags or {}):
+            times = []
+            columns = {}
+            for path in self.__partitions(series_path, start, end):
+                t, c = self.__read(path, start, end)
+                for column in set(columns)|set(c):
+                    columns.setdefault(column, [float('nan')]*len(times)).extend(c.get(column, [float('nan')]*len(t)))
+                times += t
+            yield series_tags, times, columns
+
+    def query(self, query, epoch=None):
+        query = query.strip()
+        lower = query.lower()
+        if lower=='show measurements' :
+            names = sorted(urllib.parse.unquote(f) for f in os.listdir(self.__directory))
+            return self.__result([{'name': 'measurements', 'columns': ['name'], 'values': [[name] for name in names]}] if names else [])
+        m = re.match(r'show tag values from "?([^"\s]+)"? with key\s*=\s*"?([^"\s]+)"?$', query, re.I)
+        if m :
+            values = sorted(set(tags[m.group(2)] for path,tags in self.__series(m.group(1), {}) if m.group(2) in tags))
+            return self.__result([{'name': m.group(1), 'columns': ['key', 'value'], 'values': [[m.group(2), v] for v in values]}] if values else [])
+        m = re.match(r'show field keys from "?([^"\s]+)"?$', query, re.I)
+        if m :
+            keys = sorted(set(column for series_path,tags in self.__series(m.group(1), {})
+                                       for path in self.__partitions(series_path, None, None) for column in self.__columns(path)))
+            return self.__result([{'name': m.group(1), 'columns': ['fieldKey', 'fieldType'], 'values': [[k, 'float'] for k in keys]}] if keys else [])
+        m = self.__select.match(query)
+        if not m :
+            raise ValueError("Unsupported query for the local store : {}".format(query))
+        return self.__result(self.__run_select(m))
+
+    @staticmethod
+    def __result(series):
+        return query_result({'results': [dict({'statement_id': 0}, **({'series': series} if series else {}))]})
+
+    def __run_select(self, m):
+        measurement = m.group('measurement')
+
+        # where : タグの一致と時刻の範囲だけ
+        tag_filter = {}
+        start = end = None
+        for condition in re.split(r'\s+and\s+', m.group('where') or '', flags=re.I):
+            if not condition :
+                continue
+            c = self.__time_condition.match(condition)
+            if c :
+                value = int(int(c.group('value'))*self.__units[(c.group('unit') or 'ns').lower()])
+                # 範囲は [start, end) にする
+                if c.group('op')[0]=='>' :
+                    value += (c.group('op')=='>')
+                    start = value if start is None else max(start, value)
+                else:
+                    value += (c.group('op')=='<=')
+                    end = value if end is None else min(end, value)
+                continue
+            c = self.__tag_condition.match(condition)
+            if not c :
+                raise ValueError("Unsupported condition for the local store : {}".format(condition))
+            tag_filter[c.group('key')] = c.group('value')
+
+        # group by : time(間隔[, ずらす時間]) と タグ
+        interval = None
+        offset = 0
+        group_tags = []
+        units = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+        for item in re.split(r',(?![^(]*\))', re.sub(r'fill\(\w+\)', '', m.group('group') or '', flags=re.I)):
+            item = item.strip()
+            t = re.match(r'time\((\d+)(ms|s|m|h|d)(?:\s*,\s*(\d+)(ms|s|m|h|d))?\)$', item, re.I)
+            if t :
+                interval = int(t.group(1))*units[t.group(2).lower()]
+                if t.group(3) :
+                    offset = int(t.group(3))*units[t.group(4).lower()]%interval
+            elif item :
+                group_tags.append(item.strip('"'))
+
+        expressions = []
+        for text in m.group('fields').split(','):
+            f = self.__field.match(text.strip())
+            if not f or (f.group('func') and f.group('func').lower() not in self.aggregates) :
+                raise ValueError("Unsupported field for the local store : {}".format(text))
+            expressions.append((f.group('func') and f.group('func').lower(), f.group('field').strip('"'), f.group('alias')))
+        if len(set(func is None for func,field,alias in expressions)) > 1 :
+            raise ValueError("Mixing aggregate and non-aggregate queries is not supported")
+
+        # 同じグループのシリーズをまとめる
+        groups = {}
+        for tags, times, columns in self.range(measurement, tag_filter, start, end):
+            groups.setdefault(tuple(tags.get(k,'') for k in group_tags), []).append((tags, times, columns))
+
+        series = []
+        for key in sorted(groups):
+            if expressions[0][0] is None :
+                columns, values = self.__raw(groups[key], expressions, group_tags)
+            else:
+                columns, values = self.__aggregate(groups[key], expressions, interval, offset, start)
+            if m.group('order') and m.group('order').lower()=='desc' :
+                values.reverse()
+            if m.group('limit') :
+                values = values[:int(m.group('limit'))]
+            if values :
+                series.append(dict({'name': measurement, 'columns': columns, 'values': values},
+                                   **({'tags': dict(zip(group_tags, key))} if group_tags else {})))
+        return series
+
+    @staticmethod
+    def __value(value):
+        return None if value!=value else value
+
+    def __raw(self, group, expressions, group_tags):
+        # フィールドに値のある行だけを時刻順に返す (* ならタグもInfluxDBと同じく列として返す)
+        targets = []
+        for func, field, alias in expressions:
+            if field=='*' :
+                targets += [(column, column) for column in sorted(set(column for tags,times,columns in group for column in columns)|
+                                                                   set(k for tags,times,columns in group for k in tags if k not in group_tags))]
+            else:
+                targets.append((field, alias or field))
+        rows = []
+        for tags, times, columns in group:
+            fields = [column for column,name in targets if column in columns]
+            for i,t in enumerate(times):
+                if any(columns[column][i]==columns[column][i] for column in fields) :
+                    rows.append([t]+[self.__value(columns[column][i]) if column in columns else tags.get(column) for column,name in targets])
+        rows.sort(key=lambda row: row[0])
+        return ['time']+[name for column,name in targets], rows
+
+    def __aggregate(self, group, expressions, interval, offset, start):
+        # (関数, 列, 列名) に展開する (last(*) は last_<列> になる)
+        targets = []
+        for func, field, alias in expressions:
+            if field=='*' :
+                targets += [(func, column, func+'_'+column) for column in sorted(set(column for tags,times,columns in group for column in columns))]
+            else:
+                targets.append((func, field, alias or func))
+
+        # 期間毎に (時刻, 値) を集める
+        buckets = {}
+        for tags, times, columns in group:
+            for i,t in enumerate(times):
+                bucket = buckets.setdefault((t-offset)//interval*interval+offset if interval else 0, {})
+                for func, column, name in targets:
+                    if column in columns and columns[column][i]==columns[column][i] :
+                        bucket.setdefault(column, []).append((t, columns[column][i]))
+
+        rows = []
+        for bucket_time in sorted(buckets):
+            row = [bucket_time if interval else (start or 0)]
+            for func, column, name in targets:
+                values = buckets[bucket_time].get(column)
+                if not values :
+                    row.append(None)
+                    continue
+                selected_time, value = self.aggregates[func](values)
+                # 集計期間を指定せずに1つだけ選んだ場合は、InfluxDBと同じくその点の時刻を返す
+                if len(targets)==1 and not interval and selected_time is not None :
+                    row[0] = selected_time
+                row.append(value)
+            if any(v is not None for v in row[1:]) :
+                rows.append(row)
+        return ['time']+[name for func, column, name in targets], rows
+
+
+class database_reader():
+    # 読み込むだけのスクリプト (ProfitGraph_export.py など) 用の接続
+    # database と違って書き込みのスレッドやスナップショット、スプールを作らない (時刻は database.query() と同じくミリ秒)
+    def __init__(self, host='', port=8086, database='', url=None, username=None, password=None, org=None, bucket=None, token=None, local_dir=None):
+        if (host!='' or bool(url)) and (database!='' or bool(bucket)) :
+            self.__client = influx_client(url=url or 'http://{}:{}'.format(host, port), database=database, username=username, password=password,
+                                          org=org, bucket=bucket, token=token)
+        elif local_dir and os.path.isdir(local_dir) :
+            self.__client = local_store(local_dir)
+        else:
+            raise FileNotFoundError("Local store not found : {}".format(local_dir))
+
+    def query(self, query):
+        return self.__client.query(query, epoch='ms')
+
+
 class database:
-    def __init__(self, logger, host='', port=8086, database=''):
+    def __init__(self, logger, host='', port=8086, database='', batch_size=1000, flush_interval=5, retry_limit=100, snapshot_file='ProfitGraph_last_value.json',
+                 spool_dir=None, spool_max_size=512*1024*1024, reconnect_interval=60, url=None, username=None, password=None, org=None, bucket=None, token=None,
+                 compact_epsilon=None, heartbeat=120, local_dir=None, pending_limit=1440):
 
         self._logger = logger
         self.__last_value = {}
-        
-        # Influx DBとの接続（もしインストールされていれば）
-        try:
-            from influxdb import InfluxDBClient
-            import urllib3
-            from urllib3.exceptions import InsecureRequestWarning
-            urllib3.disable_warnings(InsecureRequestWarning)
-        except Exception as e:
-            self._logger.exception("Influxdb module import error : {}, {}".format(e, traceback.print_exc()))
-
-        if host!='' and database!='' :
-            try:
-                self.__client = InfluxDBClient(host=host, port=port, database=database)
-                self.__client.query('show measurements')  # 接続テスト
-            except Exception as e:
-                self._logger.error("Influxdb connection error : {}".format(e))
-                self.__client = None
+        self.__cumulative = {}
+        self.__rollup = {}
+        self.__last_written = {}
+        self.__snapshot_file = snapshot_file
+        # 前回値が確定した取引所と、確定するまで取っておく点 (pending_limit点たまったら諦めて書き込む)
+        self.__baseline = set()
+        self.__pending = {}
+        self.__pending_limit = pending_limit
+        self.__saved = {'last_value': {}, 'cumulative': {}, 'last_written': {}}
+        self.__lock = threading.Lock()
+
+        # 書き込みバッファ (ラインプロトコルの行。flush_interval秒毎、もしくはbatch_size件たまったらまとめて書き込む)
+        self.__buffer = []
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__flush_event = threading.Event()
+        self.__flush_lock = threading.Lock()
+        # 書き込みに失敗したバッチの再送キュー (古いものから捨てる)
+        self.__retry_queue = deque(maxlen=retry_limit)
+
+        # 圧縮モード (compact_epsilon を指定した場合)
+        # 前回書き込んだ値から compact_epsilon (数値、もしくはフィールド毎の辞書) を超えて動いた時と、heartbeat秒毎にだけ balance を書き込む
+        # (ダッシュボードの fill(previous) は表示期間より前の値を見ないので、heartbeat はパネルの最小間隔 dashboard_interval 以下にする)
+        self.__epsilon = compact_epsilon
+        self.__heartbeat = heartbeat
+
+        # Influx DBとの接続 (url を省略したら host と port から。bucket を指定したら 2.x)
+        self.__client_params = {'url': url or 'http://{}:{}'.format(host, port), 'database': database, 'username': username, 'password': password,
+                                'org': org, 'bucket': bucket, 'token': token}
+        influx_enabled = ((host!='' or bool(url)) and (database!='' or bool(bucket)))
+        # InfluxDBを指定しなければ local_dir のフォルダに保存する (どちらも無ければログに出すだけ)
+        self.__local_dir = None if influx_enabled else local_dir
+        self.__enabled = influx_enabled or bool(local_dir)
+        self.__reconnect_interval = reconnect_interval
+        self.__client = None
+        if self.__enabled :
+            self.__connect()
+            if self.__local_dir :
+                self._logger.info("Use the local store : {}".format(self.__local_dir))
         else:
             self._logger.info("Skip connecting for Influxdb")
+
+        # InfluxDBに書き込めない間のポイントはファイルに退避しておき、再接続できたらまとめて書き込む
+        self.__spool = write_spool(logger, spool_dir, max_size=spool_max_size) if (influx_enabled and spool_dir) else None
+
+        # 差分計算のための前回値を起動時に読み込んでおく
+        if self.__enabled :
+            self.__load_snapshot()
+            if self.__client != None :
+                try:
+                    self.__settle(self.__saved['last_value'])
+                except Exception as e:
+                    self._logger.error("Error while loading last values : {}".format(e))
+
+        self.__flush_thread = threading.Thread(target=self.__flush_loop, name='influxdb_writer', daemon=True)
+        self.__flush_thread.start()
+        atexit.register(self.close)
+
+    def __connect(self):
+        try:
+            client = local_store(self.__local_dir) if self.__local_dir else influx_client(**self.__client_params)
+            client.query('show measurements')  # 接続テスト
+            self.__client = client
+        except Exception as e:
+            self._logger.error("Influxdb connection error : {}".format(e))
             self.__client = None
+        self.__reconnect_time = time.time()+self.__reconnect_interval
 
 
-    def write( self, measurement, tags='', **kwargs ):
+    def write( self, measurement, tags='', timestamp=None, **kwargs ):
+        # 複数のスレッドから同時に呼ばれるのでクライアントへのアクセスは排他する
+        start = time.perf_counter()
+        with self.__lock:
+            result = self.__write( measurement, tags, timestamp, **kwargs )
+        perf.add('database.write', time.perf_counter()-start, error=(result==""))
+        return result
+
+    def __write( self, measurement, tags='', timestamp=None, **kwargs ):
         try:
-            fields = copy.deepcopy( kwargs )
-            if self.__client != None :
+            fields = dict( kwargs )
+
+            # 書き込みは後でまとめて行うので、時刻は今の時点で付けておく (予定時刻(ms)が指定されていればそれを使う)
+            if timestamp == None :
+                timestamp = int(time.time()*1000)
+
+            if self.__enabled :
                 if tags!='' and 'exchange' in tags:
 
-                    last_value_dict = self.__last_value.get(tags['exchange'],{})
-                    for key,val in kwargs.items():
+                    # 前回値がまだ確定していなければ (起動直後やInfluxDBに接続できない間)、確定してから差分を計算する
+                    if tags['exchange'] not in self.__baseline :
+                        self.__defer(tags['exchange'], measurement, tags, timestamp, kwargs)
+                        return kwargs
 
-                        # 前回の値(self.__last_valueに保存)から呼び出す
-                        last_value = last_value_dict.get(key,0)
+                    last_value_dict = self.__last_value.get(tags['exchange'],{})
 
-                        if last_value==0 :
-                            # 前回の値が無い場合には influxdb へ問い合わせて最後の値を呼び出す
-                            query = "select last(\"{}\") from \"balance\" where \"exchange\"='{}'".format(key,tags['exchange'])
-                            result = list(self.__client.query(query).get_points(measurement='balance'))
-                            if result :
-                                last_value = result[-1]['last']
+                    # 変化が無ければ書き込まない (前回値は書き込んだ時の値のままにしておくので、次に書き込む点の diff_ に間の変化が全て入る)
+                    if self.__epsilon is not None and not self.__changed(last_value_dict, kwargs) and \
+                       timestamp < self.__last_written.get(tags['exchange'],0)+self.__heartbeat*1000 :
+                        if measurement=='balance' :
+                            self.__update_rollup(tags['exchange'], timestamp, fields)
+                        perf.count('suppressed_points')
+                        return kwargs
+                    self.__last_written[tags['exchange']] = timestamp
+                    for key,val in kwargs.items():
 
-                        if last_value!=0 :
-                           # 変化分をキーにして格納
-                            fields['diff_'+key]=float(val-last_value)
+                        # 前回の値(self.__last_valueに保存)があれば変化分をキーにして格納
+                        # (値が0でも記録済みなら既知の値として扱う)
+                        if key in last_value_dict :
+                            fields['diff_'+key]=float(val-last_value_dict[key])
                         else:
                             fields['diff_'+key]=float(0)
 
@@ -88,105 +901,651 @@ class database:
 
                     self.__last_value[tags['exchange']] = last_value_dict
 
+                    # 変化分の累積 (ダッシュボードで cumulative_sum しなくても済むように)
+                    cumulative_dict = self.__cumulative.setdefault(tags['exchange'],{})
+                    for key in self.cumulative_keys:
+                        if 'diff_'+key in fields :
+                            cumulative_dict[key] = cumulative_dict.get(key,0)+fields['diff_'+key]
+                            fields['cum_'+key] = float(cumulative_dict[key])
+
             if tags=='':
-                data = [{"measurement": measurement, "fields": kwargs}]
+                point = {"measurement": measurement, "time": timestamp, "fields": kwargs}
             else:
-                data = [{"measurement": measurement, "tags": tags, "fields": fields}]
+                point = {"measurement": measurement, "tags": tags, "time": timestamp, "fields": fields}
 
-            if self.__client != None :
-                self.__client.write_points(data)
+            self.__buffer.append(line_protocol(point))
+            if self.__enabled and measurement=='balance' and tags!='' and 'exchange' in tags:
+                self.__update_rollup(tags['exchange'], timestamp, fields)
+
+            if len(self.__buffer) >= self.__batch_size :
+                self.__flush_event.set()
 
-            else:
-                self._logger.info( data )
         except Exception as e:
             self._logger.exception("Influxdb write error : {}, {}".format(e, traceback.print_exc()))
             return ""
 
         return kwargs
 
+    def __changed(self, last_value_dict, values):
+        for key,val in values.items():
+            epsilon = self.__epsilon.get(key,0) if isinstance(self.__epsilon, dict) else self.__epsilon
+            if key not in last_value_dict or abs(val-last_value_dict[key]) > epsilon :
+                return True
+        return False
+
+    # ダッシュボードで fill(previous) を使うパネルの最小間隔 (秒)
+    dashboard_interval = 120
+
+    # 累積を記録するキー
+    cumulative_keys = ('jpy', 'fixjpy', 'btc', 'fixbtc')
+
+    def cumulative_total(self):
+        # 全取引所の累積の合計
+        with self.__lock:
+            return dict([(key,sum(c.get(key,0) for c in self.__cumulative.values())) for key in self.cumulative_keys])
+
+    # 長期間のグラフ用に 1時間/1日 毎の集計を書き込み時に作っておく (時間の区切りはInfluxDBと同じUTC)
+    # 期間の最後の値は balance と同じフィールド名にする (ダッシュボードで $resolution を切り替えるだけで同じクエリを使えるように)
+    rollup_periods = {'balance_1h': 3600, 'balance_1d': 86400}
+    rollup_keys = ('jpy', 'fixjpy', 'btc', 'pos', 'spot')
+
+    def __update_rollup(self, exchange_name, timestamp, fields):
+        for measurement, period in self.rollup_periods.items():
+            rollup_dict = self.__rollup.setdefault(measurement, {})
+            bucket = int(timestamp/1000//period*period)
+            state = rollup_dict.get(exchange_name)
+
+            # 区切りを越えたら前の期間の集計を書き込む
+            if state and state['time']!=bucket :
+                self.__buffer.append(line_protocol(self.__rollup_point(measurement, exchange_name, state)))
+                state = None
+            if not state :
+                state = rollup_dict[exchange_name] = {'time': bucket}
+
+            for key in self.rollup_keys:
+                if key not in fields :
+                    continue
+                val = float(fields[key])
+                if key+'_count' in state :
+                    state[key+'_count'] += 1
+                    state[key+'_sum'] += val
+                    state[key+'_min'] = min(state[key+'_min'], val)
+                    state[key+'_max'] = max(state[key+'_max'], val)
+                else:
+                    state.update({key+'_count':1, key+'_sum':val, key+'_min':val, key+'_max':val})
+                state[key+'_last'] = val
+
+            for key,val in fields.items():
+                if key.startswith('diff_'):
+                    state[key] = state.get(key,0)+float(val)
+                elif key.startswith('cum_'):
+                    state[key] = float(val)
+
+    def __rollup_point(self, measurement, exchange_name, state):
+        fields = {}
+        for key in self.rollup_keys:
+            if key+'_count' in state :
+                fields[key] = state[key+'_last']
+                fields[key+'_mean'] = state[key+'_sum']/state[key+'_count']
+                for agg in ('min', 'max'):
+                    fields[key+'_'+agg] = state[key+'_'+agg]
+        fields.update(dict([(key,val) for key,val in state.items() if key.startswith('diff_') or key.startswith('cum_')]))
+        return {"measurement": measurement, "tags": {'exchange': exchange_name}, "time": state['time']*1000, "fields": fields}
+
+    def build_rollups(self, start, end, chunk_days=30):
+        # 既存の balance から集計を作り直す (InfluxDBの SELECT INTO で期間を区切って実行)
+        if self.__client == None :
+            self._logger.error("Influxdb is not connected")
+            return
+        if self.__local_dir :
+            self._logger.error("SELECT INTO is not supported by the local store")
+            return
+        selects = []
+        for key in self.rollup_keys:
+            selects += ['last("{0}") as "{0}"'.format(key), 'mean("{0}") as "{0}_mean"'.format(key),
+                        'min("{0}") as "{0}_min"'.format(key), 'max("{0}") as "{0}_max"'.format(key)]
+        field_keys = self.__field_keys('balance')
+        selects += ['sum("{0}") as "{0}"'.format(key) for key in field_keys if key.startswith('diff_')]
+        # 累積は期間の最後の値 (書き込み時に作る集計と同じ)
+        selects += ['last("{0}") as "{0}"'.format(key) for key in field_keys if key.startswith('cum_')]
+
+        for measurement, period in self.rollup_periods.items():
+            chunk_start = start
+            while chunk_start < end :
+                chunk_end = min(chunk_start+timedelta(days=chunk_days), end)
+                query = 'select {} into "{}" from "balance" where time >= {}s and time < {}s group by time({}s), "exchange"'.format(
+                            ','.join(selects), measurement, int(chunk_start.timestamp()), int(chunk_end.timestamp()), period)
+                self.__client.query(query)
+                self._logger.info("Build {} : {} - {}".format(measurement, chunk_start, chunk_end))
+                chunk_start = chunk_end
+
+    def query(self, query):
+        # 時刻はミリ秒で返す (接続していなければ None)
+        if self.__client == None :
+            return None
+        return self.__client.query(query, epoch='ms')
+
+    def write_lines(self, lines):
+        # ラインプロトコルの行をバッファを通さずにまとめて書き込む (失敗したら例外のまま)
+        if self.__client == None :
+            raise ConnectionError("Not connected")
+        self.__client.write_points(lines, protocol='line', time_precision='ms', batch_size=self.__batch_size*10)
+
+    def __field_keys(self, measurement):
+        result = self.__client.query('show field keys from "{}"'.format(measurement))
+        return [point['fieldKey'] for point in result.get_points()]
+
+    def __target(self):
+        # スナップショットを保存した書き込み先 (別の書き込み先のスナップショットは使わない)
+        return self.__local_dir or '{}/{}'.format(self.__client_params['url'], self.__client_params['bucket'] or self.__client_params['database'])
+
+    def __load_snapshot(self):
+        # 前回終了時のスナップショット (書き込む前に保存しているので、書き込み先の最後の点より古くなることは無い)
+        try:
+            with open(self.__snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot.get('target')!=self.__target() :
+                self._logger.info("Ignore {} : saved for another database".format(self.__snapshot_file))
+                return
+            self.__saved = dict([(key,snapshot.get(key,{})) for key in ('last_value', 'cumulative', 'last_written')])
+            self.__rollup = snapshot.get('rollup',{})
+            self._logger.info("Load {} ({} exchanges)".format(self.__snapshot_file, len(snapshot['last_value'])))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self._logger.error("Error while loading {} : {}".format(self.__snapshot_file, e))
+
+    def __defer(self, name, measurement, tags, timestamp, kwargs):
+        # 前回値が確定するまで点を取っておく
+        points = self.__pending.setdefault(name, [])
+        points.append((timestamp, len(points), measurement, tags, kwargs))
+        if len(points) < self.__pending_limit :
+            return
+        # 長く接続できなければスナップショットの値から (無ければ最初の点から) 始める
+        self._logger.error("Baseline of {} is unknown for {} points. Start from the saved values".format(name, len(points)))
+        self.__apply_baseline(name, copy.deepcopy(self.__saved['last_value'].get(name,{})), copy.deepcopy(self.__saved['cumulative'].get(name,{})),
+                              self.__saved['last_written'].get(name,0))
+
+    def __apply_baseline(self, name, last_value, cumulative, last_written):
+        self.__last_value[name] = last_value
+        self.__cumulative[name] = cumulative
+        self.__last_written[name] = last_written
+        self.__baseline.add(name)
+        for timestamp, seq, measurement, tags, kwargs in sorted(self.__pending.pop(name, []), key=lambda p: p[:2]):
+            self.__write(measurement, tags, timestamp, **kwargs)
+
+    def __settle(self, names=()):
+        # 前回値が確定していない取引所について前回値を決め、取っておいた点を書き込む
+        # (スナップショットにある取引所は問い合わせずにそのまま使い、無い取引所だけ InfluxDB から読み込む)
+        with self.__lock:
+            names = sorted((set(self.__pending)|set(names))-self.__baseline)
+        if not names :
+            return
+        saved = self.__saved
+        from_snapshot = [name for name in names if name in saved['last_value']]
+        from_db = [name for name in names if name not in saved['last_value']]
+        last_times, last_values, cumulatives = self.__query_last_values(from_db) if from_db else ({}, {}, {})
+
+        with self.__lock:
+            for name in names:
+                if name in self.__baseline :
+                    continue
+                if name in from_snapshot :
+                    self.__apply_baseline(name, copy.deepcopy(saved['last_value'][name]), copy.deepcopy(saved['cumulative'].get(name,{})),
+                                          saved['last_written'].get(name,0))
+                else:
+                    # 書き込み先に無ければ新しい取引所
+                    self.__apply_baseline(name, last_values.get(name,{}), cumulatives.get(name,{}), last_times.get(name,0))
+        self._logger.info("Load last values of {} exchanges ({} from {}, {} from influxdb)".format(
+                          len(names), len(from_snapshot), self.__snapshot_file, len(last_times)))
+
+    def __query_last_values(self, names):
+        # 1つならその取引所だけ、複数なら全取引所をまとめて1回で問い合わせる
+        where = ' where "exchange"=\'{}\''.format(names[0].replace("'", "\\'")) if len(names)==1 else ''
+        # 最後の点の時刻 (書き込み先に無ければ新しい取引所)
+        last_times = {}
+        for (measurement, tags), points in self.__client.query('select last("jpy") from "balance"{} group by "exchange"'.format(where), epoch='ms').items():
+            for point in points:
+                if tags['exchange'] in names :
+                    last_times[tags['exchange']] = point['time']
+        last_values = dict([(name,{}) for name in names])
+        cumulatives = dict([(name,{}) for name in names])
+        for (measurement, tags), points in self.__client.query('select last(*) from "balance"{} group by "exchange"'.format(where)).items():
+            if tags['exchange'] not in last_values :
+                continue
+            for point in points:
+                for key,val in point.items():
+                    if not key.startswith('last_') or val is None:
+                        continue
+                    key = key[len('last_'):]
+                    if key.startswith('cum_'):
+                        cumulatives[tags['exchange']][key[len('cum_'):]] = val
+                    elif not key.startswith('diff_'):
+                        last_values[tags['exchange']][key] = val
+
+        # まだ累積を記録していない取引所は、これまでの変化分の合計から始める
+        if any(len(c)<len(self.cumulative_keys) for c in cumulatives.values()):
+            query = 'select {} from "balance"{} group by "exchange"'.format(','.join('sum("diff_{0}") as "{0}"'.format(key) for key in self.cumulative_keys), where)
+            for (measurement, tags), points in self.__client.query(query).items():
+                cumulative_dict = cumulatives.get(tags['exchange'])
+                if cumulative_dict is None :
+                    continue
+                for point in points:
+                    for key in self.cumulative_keys:
+                        if key not in cumulative_dict and point.get(key) is not None:
+                            cumulative_dict[key] = point[key]
+        return last_times, last_values, cumulatives
+
+    def __save_last_value(self, snapshot):
+        # 一時ファイルに書いてから置き換える (書き込み途中で落ちても壊れないように)
+        try:
+            tmp_file = self.__snapshot_file+'.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, self.__snapshot_file)
+        except Exception as e:
+            self._logger.error("Error while saving {} : {}".format(self.__snapshot_file, e))
 
-class online_information():
-    def _update(self, target):
-        # 直近30秒アップデートされていなければ取得する
-        while target['update_time']+30<time.time() :
+    def flush(self):
+        # バックグラウンドでの書き込みを要求する (完了は待たない)
+        self.__flush_event.set()
+
+    def close(self):
+        # 残っているポイントを書き込んでから終了
+        self.__flush_batches()
+
+    def __flush_loop(self):
+        while True:
+            self.__flush_event.wait(self.__flush_interval)
+            self.__flush_event.clear()
             try:
-                target['update_handler']()
+                self.__flush_batches()
             except Exception as e:
-                self._logger.exception("Error while getting {} : {}, {}".format(target['name'], e, traceback.print_exc()))
-                if target['price'] != 0:
-                    break
-                time.sleep(10)
-        
-    
-class exchange_rate(online_information):
+                self._logger.exception("Influxdb flush error : {}, {}".format(e, traceback.print_exc()))
+
+    def __flush_batches(self):
+        # 書き込みスレッドと終了処理が同時に書き込まないように排他する
+        with self.__flush_lock:
+            self.__flush_batches_locked()
+
+    def __flush_batches_locked(self):
+        if self.__enabled :
+            # 切断中は一定間隔で再接続を試みる
+            if self.__client == None and self.__reconnect_time < time.time() :
+                self.__connect()
+            # 接続できたら、スプールを書き込む前に前回値が確定していない取引所を確定させる
+            if self.__client != None and self.__pending :
+                try:
+                    self.__settle()
+                except Exception as e:
+                    self._logger.error("Error while loading last values : {}".format(e))
+
+        with self.__lock:
+            data, self.__buffer = self.__buffer, []
+            # 前回値が確定していない取引所はスナップショットの値を残しておく
+            snapshot = {'target': self.__target(), 'rollup': self.__rollup}
+            for key, values in (('last_value', self.__last_value), ('cumulative', self.__cumulative), ('last_written', self.__last_written)):
+                snapshot[key] = dict(self.__saved[key], **values)
+            snapshot = copy.deepcopy(snapshot)
+        if data :
+            # 前回値は書き込む前に保存する (書き込んだ後で落ちても、スナップショットが書き込み先より古くならないように)
+            # (これで次回起動時はスナップショットにある取引所の問い合わせを省略できる)
+            if self.__enabled :
+                self.__save_last_value(snapshot)
+            if len(self.__retry_queue)==self.__retry_queue.maxlen :
+                if self.__spool :
+                    self.__spool_batch(self.__retry_queue.popleft())
+                else:
+                    self._logger.error("Influxdb retry queue is full. Drop {} points".format(len(self.__retry_queue[0])))
+            self.__retry_queue.append(data)
+
+        if not self.__enabled :
+            while self.__retry_queue :
+                self._logger.info( self.__retry_queue.popleft() )
+            return
+
+        # 古いバッチから順に書き込み、失敗したら次回に再送する (スプールがあればファイルに退避する)
+        while self.__retry_queue :
+            batch = self.__retry_queue[0]
+            if batch is not data :
+                perf.count('write_retries')
+            start = time.perf_counter()
+            try:
+                if self.__client == None :
+                    raise ConnectionError("Not connected")
+                self.__client.write_points(batch, protocol='line', time_precision='ms', batch_size=self.__batch_size)
+                perf.add('write_points', time.perf_counter()-start, group='influxdb')
+            except Exception as e:
+                perf.add('write_points', time.perf_counter()-start, error=True, group='influxdb')
+                self._logger.error("Influxdb write error : {} ({} batches are waiting)".format(e, len(self.__retry_queue)))
+                if self.__client != None :
+                    self.__client = None
+                    self.__reconnect_time = time.time()+self.__reconnect_interval
+                if not self.__spool :
+                    return
+                self.__spool_batch(batch)
+            self.__retry_queue.popleft()
+
+        # 書き込めるようになったら退避していたポイントをまとめて書き込む
+        if self.__spool and self.__client != None :
+            try:
+                count = self.__spool.replay(lambda lines: self.__client.write_points(lines, protocol='line', time_precision='ms'), chunk_size=self.__batch_size*10)
+                if count :
+                    self._logger.info("Replayed {:,} spooled points".format(count))
+                    perf.count('replayed_points', count)
+            except Exception as e:
+                self._logger.error("Influxdb write error while replaying spool : {}".format(e))
+                self.__client = None
+                self.__reconnect_time = time.time()+self.__reconnect_interval
+
+    def __spool_batch(self, batch):
+        try:
+            self.__spool.append(batch)
+            perf.count('spooled_points', len(batch))
+        except Exception as e:
+            self._logger.error("Error while spooling {} points : {}".format(len(batch), e))
 
-    def __init__(self, logger, db):
+
+class online_information():
+    # 直近30秒アップデートされていなければ取得する (失敗した場合は10秒後に再取得)
+    _refresh_interval = 30
+    _retry_interval = 10
+
+    def _start_refresher(self, targets):
+        # 取得はバックグラウンドのスレッドで行い、呼び出し側は待たずに直近の値を使う
+        self.__targets = targets
+        self.__ready = threading.Event()
+        self.__refresher = threading.Thread(target=self.__refresh_loop, name='refresher_'+self.__class__.__name__, daemon=True)
+        self.__refresher.start()
+
+    def __refresh_loop(self):
+        perf.set_group('rates')
+        while True:
+            # 保存してあった値で全て揃っていれば、取得を待たずに使い始める
+            if all(target['update_time']!=0 for target in self.__targets):
+                self.__ready.set()
+
+            now = time.time()
+            for target in self.__targets:
+                if max(target['update_time']+self._refresh_interval, target.get('retry_time',0)) > now :
+                    continue
+                try:
+                    target['update_handler']()
+                except Exception as e:
+                    perf.count('rate_errors')
+                    self._logger.error("Error while getting {} : {}".format(target['name'], e))
+                    self._logger.info(traceback.format_exc())
+                    target['retry_time'] = time.time()+self._retry_interval
+
+            if all(target['update_time']!=0 for target in self.__targets):
+                self.__ready.set()
+
+            # 次に取得が必要になる時刻まで眠る
+            next_time = min(max(target['update_time']+self._refresh_interval, target.get('retry_time',0)) for target in self.__targets)
+            time.sleep(min(max(next_time-time.time(), 0.1), self._refresh_interval))
+
+    def wait_ready(self, timeout=None):
+        # 起動直後に全ての値が一度取得されるまで待つ
+        return self.__ready.wait(timeout)
+
+    def _age(self, target):
+        return time.time()-target['update_time']
+
+
+class rate_snapshot(namedtuple('rate_snapshot', ['usdjpy', 'xbtusd', 'ethusd', 'btcjpy', 'fxbtcjpy', 'open_interest', 'open_value', 'age', 'prices'])):
+    # 1サイクルの間に全取引所で共通して使うレート (ageは各値の取得からの経過秒数, pricesは設定した全てのレート)
+    __slots__ = ()
+
+    @property
+    def xbtjpy(self):
+        return self.usdjpy * self.xbtusd / 100000000
+
+    def price(self, name):
+        # 設定で追加したレート (exchange_rate と同じ呼び方)
+        return self.prices[name]
+
+
+class stream_feed():
+    # WebSocketで配信されるティッカーを購読する (切断されたら再接続)
+    def __init__(self, logger, name, url, subscribe_messages, message_handler, ping_message=None, ping_interval=20):
         self._logger = logger
-        self._db = db
-        self._bitflyer_publicapi = ccxt.bitflyer()
+        self._name = name
+        self._url = url
+        self.__subscribe_messages = subscribe_messages
+        self.__message_handler = message_handler
+        self.__ping_message = ping_message
+        self.__ping_interval = ping_interval
+        self.__ping_time = 0
+        self.__retry_wait = 1
+        self.__thread = threading.Thread(target=self.__run_loop, name='stream_'+name, daemon=True)
+        self.__thread.start()
+
+    def __run_loop(self):
+        import websocket
+        while True:
+            try:
+                ws = websocket.WebSocketApp(self._url, on_open=self.__on_open, on_message=self.__on_message, on_error=self.__on_error)
+                ws.run_forever(ping_interval=self.__ping_interval, ping_timeout=10)
+            except Exception as e:
+                self._logger.error("Error in {} stream : {}".format(self._name, e))
+
+            # 切断されたら待ち時間を延ばしながら再接続する (その間はREST APIで取得される)
+            self._logger.info("{} stream disconnected. Reconnect after {}sec".format(self._name, self.__retry_wait))
+            time.sleep(self.__retry_wait)
+            self.__retry_wait = min(self.__retry_wait*2, 60)
 
-        self.__usdjpy = {'name': 'USDJPY', 'price':0, 'update_time':time.time()-100, 'update_handler': self.__update_usdjpy}
+    def __on_open(self, ws):
+        self._logger.info("{} stream connected : {}".format(self._name, self._url))
+        for message in self.__subscribe_messages:
+            ws.send(json.dumps(message))
 
-        self.__xbtusd = {'name': 'XBTUSD', 'price':0, 'update_time':time.time()-100, 'update_handler': self.__update_xbtusd}
-        self.__ethusd = {'name': 'ETHUSD', 'price':0, 'update_time':time.time()-100, 'update_handler': self.__update_ethusd}
+    def __on_message(self, ws, message):
+        try:
+            self.__message_handler(json.loads(message))
+            self.__retry_wait = 1
+        except Exception as e:
+            self._logger.error("Error while parsing {} stream : {} {}".format(self._name, e, message))
 
-        self.__btcjpy = {'name': 'BTC_JPY', 'price':0, 'update_time':time.time()-100, 'update_handler': self.__update_btcjpy}
-        self.__fxbtcjpy = {'name': 'FX_BTC_JPY', 'price':0, 'update_time':time.time()-100, 'update_handler': self.__update_fxbtcjpy}
+        # アプリケーションレベルのpingが必要な取引所向け
+        if self.__ping_message and self.__ping_time+self.__ping_interval < time.time():
+            self.__ping_time = time.time()
+            ws.send(json.dumps(self.__ping_message))
 
-    def __update_usdjpy(self):
-        # Get JPYUSD from Gaitame-online
-        res = requests.get('https://www.gaitameonline.com/rateaj/getrate').json()
-        for q in res['quotes']:
-            if (q['currencyPairCode'] == 'USDJPY'):
-                self.__usdjpy['price'] = (float(q['bid']) + float(q['ask'])) / 2.0
-                self.__usdjpy['update_time'] = time.time()
-                break
-        self._logger.info( "update USDJPY={:.1f}".format(self.__usdjpy['price']) )
-        if self.__xbtusd['price']!=0:
+    def __on_error(self, ws, error):
+        self._logger.error("Error in {} stream : {}".format(self._name, error))
+
+
+class exchange_rate(online_information):
+
+    # ストリーミングの接続先 (テスト用のサーバーなどに差し替える場合は stream_urls で指定)
+    default_stream_urls = {
+        'bitmex':   'wss://ws.bitmex.com/realtime?subscribe=instrument:XBTUSD',
+        'bybit':    'wss://stream.bybit.com/realtime',
+        'bitflyer': 'wss://ws.lightstream.bitflyer.com/json-rpc',
+    }
+
+    # 取得するレート {名前: (取得元, シンボル)} (settings の rates で追加・変更できる)
+    default_rates = {
+        'usdjpy':   ('gaitame',  'USDJPY'),
+        'xbtusd':   ('bitmex',   'XBTUSD'),
+        'ethusd':   ('bybit',    'ETHUSD'),
+        'btcjpy':   ('bitflyer', 'BTC_JPY'),
+        'fxbtcjpy': ('bitflyer', 'FX_BTC_JPY'),
+    }
+
+    def __init__(self, logger, db, streaming=False, stream_urls=None, rates=None, saved=None):
+        self._logger = logger
+        self._db = db
+        self.__market_write_time = {'mex_market':0, 'bf_market':0}
+        self.__instrument_handlers = []
+
+        # 名前毎の価格の表
+        self.__prices = {}
+        for name,(source,symbol) in dict(self.default_rates, **(rates or {})).items():
+            if source not in self.rate_sources :
+                # 既定のレートは既定の取得元に戻す (合計の計算に必ず使うので)。それ以外は取得しない
+                if name not in self.default_rates :
+                    self._logger.error("Unknown rate source for {} : {}".format(name, source))
+                    continue
+                self._logger.error("Unknown rate source for {} : {}. Use {} instead".format(name, source, self.default_rates[name][0]))
+                source, symbol = self.default_rates[name]
+            self.__prices[name] = {'name': name, 'source': source, 'symbol': symbol, 'price':0, 'update_time':0}
+        self.__usdjpy, self.__xbtusd, self.__ethusd, self.__btcjpy, self.__fxbtcjpy = \
+            [self.__prices[name] for name in ('usdjpy', 'xbtusd', 'ethusd', 'btcjpy', 'fxbtcjpy')]
+
+        # 前回終了時に保存したレート (取得した時刻もそのまま引き継ぐので、古いものはすぐに取得し直される)
+        for name,values in (saved or {}).items():
+            if name in self.__prices :
+                self.__prices[name].update(price=values['price'], update_time=values['update_time'])
+
+        # 取得は取引所毎にまとめて行う
+        self.__sources = {}
+        for price in self.__prices.values():
+            source = self.__sources.setdefault(price['source'], {'name': price['source'], 'update_time':0, 'prices':[]})
+            source['prices'].append(price)
+            source['update_handler'] = (lambda source=source: self.__update_source(source))
+        for source in self.__sources.values():
+            source['update_time'] = min(p['update_time'] for p in source['prices'])
+
+        # ストリーミングで受信している間は価格が常に新しいので、REST APIでの取得は行われない
+        if streaming :
+            self.__start_streaming(dict(self.default_stream_urls, **(stream_urls or {})))
+
+        self._start_refresher(list(self.__sources.values()))
+
+    def __start_streaming(self, urls):
+        try:
+            import websocket
+        except Exception as e:
+            self._logger.error("websocket-client module import error : {}. Use REST API only".format(e))
+            return
+
+        self.__streams = [
+            stream_feed(self._logger, 'bitmex', urls['bitmex'], [], self.__on_bitmex_message),
+            stream_feed(self._logger, 'bybit', urls['bybit'], [{'op':'subscribe', 'args':['instrument_info.100ms.ETHUSD']}],
+                        self.__on_bybit_message, ping_message={'op':'ping'}),
+            stream_feed(self._logger, 'bitflyer', urls['bitflyer'],
+                        [{'method':'subscribe', 'params':{'channel':'lightning_ticker_BTC_JPY'}},
+                         {'method':'subscribe', 'params':{'channel':'lightning_ticker_FX_BTC_JPY'}}],
+                        self.__on_bitflyer_message),
+            ]
+
+    def __set_stream_price(self, target, price, measurement=None):
+        target['price'] = price
+        target['update_time'] = time.time()
+        # 取得元の全てのシンボルを受信していれば REST API での取得は不要
+        source = self.__sources[target['source']]
+        source['update_time'] = min(p['update_time'] for p in source['prices'])
+
+        # 市場データは REST API での取得と同じく30秒毎に記録する
+        if measurement==None or self.__market_write_time[measurement]+30 > target['update_time'] :
+            return
+        if measurement=='mex_market' and self.__usdjpy['price']!=0 and self.__xbtusd['price']!=0:
+            self.__market_write_time[measurement] = target['update_time']
             self._db.write( measurement="mex_market",
                         xbtusd=float(self.__xbtusd['price']),
                         usdjpy=float(self.__usdjpy['price']),
                         xbtjpy=float(self.__usdjpy['price']*self.__xbtusd['price']))
+        elif measurement=='bf_market' and self.__btcjpy['price']!=0 and self.__fxbtcjpy['price']!=0:
+            self.__market_write_time[measurement] = target['update_time']
+            self._db.write( measurement="bf_market",
+                        fx=float(self.__fxbtcjpy['price']),
+                        spot=float(self.__btcjpy['price']))
 
-    def __update_xbtusd(self):
-        unixtime = calendar.timegm(datetime.utcnow().utctimetuple())
-        url = 'https://www.bitmex.com/api/udf/history?symbol=XBTUSD&resolution=60&from=' + str(int(unixtime)-60) + '&to=' + str(unixtime)
-        ohlcv = requests.get(url).json()
-        self.__xbtusd['price'] = (ohlcv['h'][0] + ohlcv['l'][0]) / 2.0
-        self.__xbtusd['update_time'] = time.time()
-        self._logger.info( "update XBTUSD={:.1f}".format(self.__xbtusd['price']) )
-        if self.__usdjpy['price']!=0:
+    def __on_bitmex_message(self, message):
+        for d in message.get('data',[]):
+            if d.get('symbol')=='XBTUSD' and d.get('midPrice'):
+                self.__set_stream_price(self.__xbtusd, float(d['midPrice']), 'mex_market')
+            if d.get('symbol')=='XBTUSD' and ('openInterest' in d or 'openValue' in d):
+                for handler in self.__instrument_handlers:
+                    handler(d)
+
+    def __on_bybit_message(self, message):
+        if message.get('topic')!='instrument_info.100ms.ETHUSD' :
+            return
+        data = message.get('data',{})
+        # snapshot は data に、 delta は data.update に入っている
+        for d in ([data] if message.get('type')=='snapshot' else data.get('update',[])):
+            if 'last_price_e4' in d:
+                self.__set_stream_price(self.__ethusd, float(d['last_price_e4'])/10000)
+
+    def __on_bitflyer_message(self, message):
+        params = message.get('params',{})
+        if params.get('channel')=='lightning_ticker_BTC_JPY':
+            self.__set_stream_price(self.__btcjpy, int(float(params['message']['ltp'])), 'bf_market')
+        elif params.get('channel')=='lightning_ticker_FX_BTC_JPY':
+            self.__set_stream_price(self.__fxbtcjpy, int(float(params['message']['ltp'])), 'bf_market')
+
+    def __update_source(self, source):
+        # 取得元へ1回問い合わせて、その取得元の全てのシンボルの価格を更新する
+        prices = self.rate_sources[source['name']](self, set(p['symbol'] for p in source['prices']))
+        now = time.time()
+        for p in source['prices']:
+            if p['symbol'] in prices :
+                p['price'] = prices[p['symbol']]
+                p['update_time'] = now
+        missing = [p['symbol'] for p in source['prices'] if p['symbol'] not in prices]
+        if missing :
+            raise ValueError("{} not found in {}".format(','.join(missing), source['name']))
+        source['update_time'] = now
+        self._logger.info( "update {}".format(', '.join('{}={:.1f}'.format(p['name'].upper(), p['price']) for p in source['prices'])) )
+        self.__write_markets(set(p['name'] for p in source['prices']))
+
+    def __write_markets(self, names):
+        if names & {'usdjpy','xbtusd'} and self.__usdjpy['price']!=0 and self.__xbtusd['price']!=0:
             self._db.write( measurement="mex_market",
                         xbtusd=float(self.__xbtusd['price']),
                         usdjpy=float(self.__usdjpy['price']),
                         xbtjpy=float(self.__usdjpy['price']*self.__xbtusd['price']))
-
-    def __update_ethusd(self):
-        ticker = requests.get('https://api.bybit.com/v2/public/tickers').json()
-        self.__ethusd['price'] = float([s['last_price'] for s in ticker['result'] if s['symbol']=='ETHUSD'][0])
-        self.__ethusd['update_time'] = time.time()
-        self._logger.info( "update ETHUSD={:.1f}".format(self.__ethusd['price']) )
-
-    def __update_btcjpy(self):
-        self.__btcjpy['price'] = int(float(self._bitflyer_publicapi.public_get_getticker(params={"product_code":"BTC_JPY"})['ltp']))
-        self.__btcjpy['update_time'] = time.time()
-        self._logger.info( "update BTCJPY={:.0f}".format(self.__btcjpy['price']) )
-        if self.__fxbtcjpy['price']!=0:
+        if names & {'btcjpy','fxbtcjpy'} and self.__btcjpy['price']!=0 and self.__fxbtcjpy['price']!=0:
             self._db.write( measurement="bf_market",
                         fx=float(self.__fxbtcjpy['price']),
                         spot=float(self.__btcjpy['price']))
 
-    def __update_fxbtcjpy(self):
-        self.__fxbtcjpy['price'] = int( self._bitflyer_publicapi.public_get_getticker(params={"product_code":"FX_BTC_JPY"})['ltp']) 
-        self.__fxbtcjpy['update_time'] = time.time()
-        self._logger.info( "update FXBTCJPY={:.0f}".format(self.__fxbtcjpy['price']) )
-        if self.__btcjpy['price']!=0:
-            self._db.write( measurement="bf_market",
-                        fx=float(self.__fxbtcjpy['price']),
-                        spot=float(self.__btcjpy['price']))
+    # 取得元毎に、必要なシンボルの価格を {シンボル: 価格} でまとめて返す
+    def __fetch_gaitame(self, symbols):
+        # 全ての通貨ペアが1回で返る
+        res = http_get('https://www.gaitameonline.com/rateaj/getrate').json()
+        return dict([(q['currencyPairCode'], (float(q['bid'])+float(q['ask']))/2.0) for q in res['quotes'] if q['currencyPairCode'] in symbols])
+
+    def __fetch_bitmex(self, symbols):
+        # bitmex_info が使う XBTUSD の建玉も同じ問い合わせで取得して渡す
+        columns = ['symbol', 'midPrice']
+        if self.__instrument_handlers :
+            symbols = symbols|{'XBTUSD'}
+            columns += ['openInterest', 'openValue']
+        res = http_get('https://www.bitmex.com/api/v1/instrument',
+                       params={'filter': json.dumps({'symbol': sorted(symbols)}), 'columns': json.dumps(columns)}).json()
+        for r in res:
+            if r['symbol']=='XBTUSD' :
+                for handler in self.__instrument_handlers:
+                    handler(r)
+        return dict([(r['symbol'], float(r['midPrice'])) for r in res if r.get('midPrice')])
+
+    def subscribe_instrument(self, handler):
+        # BitMEXの XBTUSD の instrument を取得・受信する度に handler に渡す (BitMEXから価格を取得しない設定なら False)
+        if 'bitmex' not in self.__sources :
+            return False
+        self.__instrument_handlers.append(handler)
+        return True
+
+    def __fetch_bybit(self, symbols):
+        # 1つだけならそのシンボルに絞って、複数なら全シンボルを1回で取得する
+        res = http_get('https://api.bybit.com/v2/public/tickers', params={'symbol': list(symbols)[0]} if len(symbols)==1 else None).json()
+        return dict([(r['symbol'], float(r['last_price'])) for r in res['result'] if r['symbol'] in symbols])
+
+    def __fetch_bitflyer(self, symbols):
+        # bitFlyer には複数のシンボルをまとめて取得するAPIが無いので1つずつ
+        return dict([(symbol, float(http_get('https://api.bitflyer.com/v1/getticker', params={'product_code': symbol}).json()['ltp'])) for symbol in symbols])
+
+    rate_sources = {
+        'gaitame':  __fetch_gaitame,
+        'bitmex':   __fetch_bitmex,
+        'bybit':    __fetch_bybit,
+        'bitflyer': __fetch_bitflyer,
+    }
 
     def __get_price(self, target):
-        self._update(target)
         return target['price']
 
     @property
@@ -213,19 +1572,56 @@ class exchange_rate(online_information):
     def btcjpy(self):
         return self.__get_price(self.__btcjpy)
 
+    def price(self, name):
+        # 設定で追加したレート
+        return self.__get_price(self.__prices[name])
+
+    def state(self):
+        # 再起動時に引き継ぐ、取得済みのレートと取得した時刻
+        return dict([(name, {'price': p['price'], 'update_time': p['update_time']}) for name,p in self.__prices.items() if p['update_time']])
+
+    def snapshot(self, bitmex):
+        # 取得済みの値をまとめて固定する (取得は待たない)
+        age = dict([(key,self._age(target)) for key,target in self.__prices.items()])
+        age['open_interest'] = age['open_value'] = bitmex.age
+        return rate_snapshot(open_interest=bitmex.open_interest, open_value=bitmex.open_value, age=MappingProxyType(age),
+                             prices=MappingProxyType(dict([(key,target['price']) for key,target in self.__prices.items()])),
+                             **dict([(key,self.__prices[key]['price']) for key in ('usdjpy', 'xbtusd', 'ethusd', 'btcjpy', 'fxbtcjpy')]))
+
 
 class bitmex_info(online_information):
-    def __init__(self, logger, db):
+    # ストリーミングでは頻繁に届くので、ログと記録は write_interval 秒毎にする
+    write_interval = 20
+
+    def __init__(self, logger, db, saved=None, rate=None):
         self._logger = logger
         self._db = db
-        self.__instrument = {'name':'Open Interest/OpenValue', 'open_interest':0, 'open_value':0, 'update_time':time.time()-100, 'update_handler': self.__update_instrument}
+        self.__instrument = {'name':'Open Interest/OpenValue', 'open_interest':0, 'open_value':0, 'price':0, 'update_time':0, 'update_handler': self.__update_instrument}
+        if saved :
+            self.__instrument.update(saved)
+        # exchange_rate が XBTUSD の価格と一緒に取得したものを使い、届かなくなった時だけ自分で取得する
+        if rate is not None and rate.subscribe_instrument(self.__set_instrument) :
+            self._refresh_interval = online_information._refresh_interval*3
+            self.__instrument['retry_time'] = time.time()+self._retry_interval
+        self._start_refresher([self.__instrument])
 
     def __update_instrument(self):
-        instrument = requests.get("https://www.bitmex.com/api/v1/instrument?symbol=XBTUSD&reverse=true").json()[0]
-        self.__instrument['open_interest'] = instrument['openInterest']
-        self.__instrument['open_value'] = instrument['openValue']
-        self.__instrument['update_time'] = time.time()
-        self.__instrument['price'] = instrument['openInterest']
+        instrument = http_get('https://www.bitmex.com/api/v1/instrument',
+                              params={'symbol': 'XBTUSD', 'columns': json.dumps(['symbol', 'midPrice', 'openInterest', 'openValue'])}).json()[0]
+        self.__set_instrument(instrument)
+
+    def __set_instrument(self, instrument):
+        # ストリーミングの更新には変化した値しか入っていない
+        self.__instrument['open_interest'] = instrument.get('openInterest', self.__instrument['open_interest'])
+        self.__instrument['open_value'] = instrument.get('openValue', self.__instrument['open_value'])
+        self.__instrument['price'] = instrument.get('midPrice') or self.__instrument['price']
+        if not (self.__instrument['open_interest'] and self.__instrument['open_value']) :
+            return
+        now = time.time()
+        self.__instrument['update_time'] = now
+        if now < self.__instrument.get('write_time',0)+self.write_interval :
+            return
+        self.__instrument['write_time'] = now
         self._logger.info( "MEX: Open_Interest={:,.0f} / Open_Value={:,.0f}".format(self.__instrument['open_interest'],self.__instrument['open_value']) )
 
         self._db.write( measurement="mex_market",
@@ -234,20 +1630,28 @@ class bitmex_info(online_information):
 
     @property
     def open_interest(self):
-        self._update(self.__instrument)
         return self.__instrument['open_interest']
 
     @property
     def open_value(self):
-        self._update(self.__instrument)
         return self.__instrument['open_value']
 
+    @property
+    def age(self):
+        return self._age(self.__instrument)
+
+    def state(self):
+        if not self.__instrument['update_time'] :
+            return None
+        return dict([(key,self.__instrument[key]) for key in ('open_interest', 'open_value', 'price', 'update_time')])
+
 class gmo_api(AuthBase):
     def __init__(self, api_key, secret):
         self.api_key, self.secret = api_key, secret
-        self.s = Session()
-        self.s.headers['Content-Type'] = 'application/json'
-        self.s.auth = self
+        # 他の取引所と同じロガー (setup_logger() で設定したもの)
+        self._logger = getLogger(__name__)
+        # セッションは他のアカウントと共有するので、認証はリクエスト毎に付ける
+        self.s = get_session('api.coin.z.com')
 
     def __call__(self, r):
         timestamp = str(int(time.time() * 1000))
@@ -263,17 +1667,35 @@ class gmo_api(AuthBase):
         return r
 
     def _get(self, path, payload):
-        req = Request('GET', 'https://api.coin.z.com/private' + path, params=payload)
+        req = Request('GET', 'https://api.coin.z.com/private' + path, params=payload, auth=self, headers={'Content-Type': 'application/json'})
         prepped = self.s.prepare_request(req)
         try:
             resp = self.s.send(prepped)
             resp.raise_for_status()
         except HTTPError as e:
             resp = None
-            print(e)
+            self._logger.error("Error while requesting GMO {} : {}".format(path, e))
         return resp
 
+_markets_cache = {}     # ccxt の取引所ID : {'time', 'markets', 'currencies'} (warm_state が保存・読み込みする)
+
+def ccxt_api(class_name, items):
+    import ccxt
+    api = getattr(ccxt, class_name)({'apiKey':items['apiKey'], 'secret':items['secret'], 'timeout':int(sum(session_timeout)*1000)})
+    # 保存してある市場情報があれば、最初の呼び出しでの load_markets() の通信を省く
+    cache = _markets_cache.get(api.id)
+    if cache :
+        api.set_markets(cache['markets'], cache['currencies'])
+    # ccxt の通信も同じホストのセッションを使い回す
+    url = api.urls['api']
+    while isinstance(url, dict):
+        url = list(url.values())[0]
+    api.session = get_session(urllib.parse.urlparse(url).netloc)
+    return api
+
 class exchange():
+    default_coins = ['BTC', 'USDT', 'ETH']
+
     def __init__(self, logger, name, items, rate, db):
         self._logger = logger
         self._exchange_type = items['type']
@@ -283,45 +1705,31 @@ class exchange():
 
         self._unreal = 0
         self._balance = 0
+        self._timestamp = None
+        # 残高に含めるコイン (マルチアセットの取引所のみ)
+        self._coins = items.get('coins', self.default_coins)
+
+        # 取引所の種類に対応するアダプタで接続する
+        adapter = self.adapters.get(self._exchange_type)
+        self._api = adapter[0](items) if adapter else None
+
+    def write_balance_to_db(self, rate=None, timestamp=None):
+        # サイクル毎に固定したレートで計算する
+        if rate != None :
+            self._rate = rate
+        # 取得した時刻ではなく予定されていた時刻(ms)で記録する
+        self._timestamp = timestamp
+
+        # 起動直後などで必要なレートがまだ無ければ記録しない (0で割ってしまうので)
+        missing = [name for name in self.required_rates.get(self._exchange_type, ())+self.coin_rates(self._exchange_type, self._coins)
+                   if not self.__rate_value(name)]
+        if missing :
+            self._logger.error("Skip {} : rates are not ready ({})".format(self._name, ','.join(missing)))
+            return 0,0,""
 
-        if self._exchange_type=='BF' :
-            self._api = ccxt.bitflyer({'apiKey':items['apiKey'], 'secret':items['secret']})
-
-        elif self._exchange_type=='Liquid' :
-            self._api = ccxt.liquid({'apiKey':items['apiKey'], 'secret':items['secret']})
-
-        elif self._exchange_type=='BITMEX' :
-            self._api = ccxt.bitmex({'apiKey':items['apiKey'], 'secret':items['secret']})
-
-        elif self._exchange_type=='BYBIT' :
-            self._api = ccxt.bybit({'apiKey':items['apiKey'], 'secret':items['secret']})
-
-#        elif self._exchange_type=='BTCMEX' :
-#            self._api = libs.ccxt.btcmex({'apiKey':items['apiKey'], 'secret':items['secret'], 'timeout':10000, 'options':{'api-expires':5}})
-        elif self._exchange_type=='PHEMEX' :
-            self._api = ccxt.phemex({'apiKey':items['apiKey'], 'secret':items['secret']})
-
-        elif self._exchange_type=='GMO' :
-            self._api = gmo_api(items['apiKey'], items['secret'])
-
-        else:
-            self._api = None
-
-    def write_balance_to_db(self):
-        if self._exchange_type == 'BF':
-            return self.__get_balance_bitflyer()
-        elif self._exchange_type == 'Liquid':
-            return self.__get_balance_liquid()
-        elif self._exchange_type == 'BITMEX':
-            return self.__get_balance_bitmex()
-        elif self._exchange_type == 'BYBIT':
-            return self.__get_balance_bybit()
-#        elif self._exchange_type == 'BTCMEX':
-#            return self.__get_balance_btcmex()
-        elif self._exchange_type == 'PHEMEX':
-            return self.__get_balance_phemex()
-        elif self._exchange_type == 'GMO':
-            return self.__get_balance_gmo()
+        adapter = self.adapters.get(self._exchange_type)
+        if adapter :
+            return adapter[1](self)
         else:
             return 0, 0, "Unsupported exchange : {}".format(self._exchange_type)
         
@@ -381,7 +1789,7 @@ class exchange():
             self._logger.error("Error while bitflyer getting balance[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance),
                         jpy=float(self._balance+self._unreal),
                         fixbtc=self._balance/self._rate.btcjpy,
@@ -426,7 +1834,7 @@ class exchange():
             self._logger.error("Error while liquid getting balance[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance),
                         jpy=float(self._balance+self._unreal),
                         fixbtc=self._balance/self._rate.btcjpy,
@@ -469,7 +1877,7 @@ class exchange():
             self._logger.error("Error while bitmex private_get_position_list[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance*self._rate.xbtjpy),
                         jpy=float(self._balance+self._unreal)*self._rate.xbtjpy,
                         fixbtc=self._balance/100000000,
@@ -480,25 +1888,60 @@ class exchange():
 
         return self._balance*self._rate.xbtjpy, self._unreal*self._rate.xbtjpy, db_str
 
+    def __rate_value(self, name):
+        # 固定のレートは属性、設定で追加したレートは price() で (まだ無ければ0)
+        if self._rate is None :
+            return 0
+        if name in rate_snapshot._fields :
+            return getattr(self._rate, name)
+        try:
+            return self._rate.price(name)
+        except KeyError:
+            return 0
+
+    # 残高を合計するコインのうち、レート表無しで換算できるもの
+    usd_coins = ('USD', 'USDT', 'USDC')
+    # 複数のコインの残高を合計する取引所の種類
+    multi_asset_types = ('BYBIT',)
+
+    @classmethod
+    def coin_rates(cls, exchange_type, coins):
+        # 残高の換算に必要な '<coin>usd' のレート
+        if exchange_type not in cls.multi_asset_types :
+            return ()
+        return tuple(coin.lower()+'usd' for coin in coins if coin!='BTC' and coin not in cls.usd_coins)
+
+    @classmethod
+    def check_coin_rates(cls, exchange_list, rate_names):
+        # 起動時に、設定されたコインのレートが取得するレートに含まれているか確かめる (足りないものをメッセージで返す)
+        errors = []
+        for name,items in exchange_list.items():
+            for rate_name in cls.coin_rates(items['type'], items.get('coins', cls.default_coins)):
+                if rate_name not in rate_names :
+                    errors.append("{} : coins needs the rate '{}'. Add it to settings: rates (e.g. {}: [bitmex, {}USD])".format(
+                                  name, rate_name, rate_name, rate_name[:-3].upper()))
+        return errors
+
+    def __to_satoshi(self, coin, amount):
+        # コインの量をレート表でBTC(satoshi)に換算する (BTC/USD/USDT以外は rates に '<coin>usd' が必要)
+        if coin=='BTC' :
+            return amount*100000000
+        usd = 1.0 if coin in self.usd_coins else self._rate.price(coin.lower()+'usd')
+        return amount*usd/self._rate.xbtusd*100000000
+
     def __get_balance_bybit(self):
         res = None
         try:
-            res = self._api.fetch_balance()
-            res_usdt = self._api.fetch_balance({"coin":"USDT"})
-            res_eth = self._api.fetch_balance({"coin":"ETH"})
-
-            self._balance = int(res['info']['result']['BTC']['wallet_balance']*100000000)+ \
-                            int(res_usdt['info']['result']['USDT']['wallet_balance']*self._rate.usdjpy/self._rate.xbtjpy)+ \
-                            int(res_eth['info']['result']['ETH']['wallet_balance']*self._rate.ethusd/self._rate.xbtusd*100000000)
-            self._unreal = int(res['info']['result']['BTC']['unrealised_pnl']*100000000)+ \
-                           int(res_usdt['info']['result']['USDT']['unrealised_pnl']*self._rate.usdjpy/self._rate.xbtjpy)+ \
-                            int(res_eth['info']['result']['ETH']['unrealised_pnl']*self._rate.ethusd/self._rate.xbtusd*100000000)
+            # coin を指定しなければ全てのコインのウォレットが1回で返る
+            res = self._api.v2_private_get_wallet_balance()
+            wallets = dict([(coin, res['result'].get(coin) or {}) for coin in self._coins])
+
+            self._balance = sum(int(self.__to_satoshi(coin, float(w.get('wallet_balance',0)))) for coin,w in wallets.items())
+            self._unreal = sum(int(self.__to_satoshi(coin, float(w.get('unrealised_pnl',0)))) for coin,w in wallets.items())
         except Exception as e:
             if res:
-                self._logger.info( "Rresponce from fetch_balance : {}".format(res) )
-            if res_usdt:
-                self._logger.info( "Rresponce from fetch_balance : {}".format(res_usdt) )
-            self._logger.error("Error while bybit fetch_balance[{}] : {}".format(self._name,e))
+                self._logger.info( "Rresponce from wallet_balance : {}".format(res) )
+            self._logger.error("Error while bybit wallet_balance[{}] : {}".format(self._name,e))
             return 0,0,""
 
         pos = None
@@ -513,14 +1956,16 @@ class exchange():
             self._logger.error("Error while bybit private_get_position_list[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance*self._rate.xbtjpy),
                         jpy=float(self._balance+self._unreal)*self._rate.xbtjpy,
                         fixbtc=self._balance/100000000,
                         btc=(self._balance+self._unreal)/100000000,
                         pos=float(posi/self._rate.xbtusd),
                         price=float(avg),
-                        spot=self._balance/100000000,)
+                        spot=self._balance/100000000,
+                        # コイン毎のウォレット残高 (コインの単位)
+                        **dict([(coin.lower()+'_wallet', float(w.get('wallet_balance',0))) for coin,w in wallets.items()]))
         
         return self._balance*self._rate.xbtjpy, self._unreal*self._rate.xbtjpy, db_str
 
@@ -552,7 +1997,7 @@ class exchange():
             self._logger.error("Error while btcmex private_get_position_list[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance*self._rate.xbtjpy),
                         jpy=float(self._balance+self._unreal)*self._rate.xbtjpy,
                         fixbtc=self._balance/100000000,
@@ -604,7 +2049,7 @@ class exchange():
             self._logger.info(traceback.format_exc())
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance*self._rate.xbtjpy),
                         jpy=float(self._balance+self._unreal)*self._rate.xbtjpy,
                         fixbtc=self._balance/100000000,
@@ -665,7 +2110,7 @@ class exchange():
             self._logger.error("Error while liquid getting balance[{}] : {}".format(self._name,e))
             return 0,0,""
 
-        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,},
+        db_str = self._db.write( measurement="balance", tags={'exchange' : self._name,}, timestamp=self._timestamp,
                         fixjpy=float(self._balance),
                         jpy=float(self._balance+self._unreal),
                         fixbtc=self._balance/self._rate.btcjpy,
@@ -676,46 +2121,895 @@ class exchange():
 
         return self._balance, self._unreal, db_str
 
+    def ledger_entries(self, until, since):
+        # 残高の変化の履歴を (時刻(ms), 変化分) で新しい順に返す (until より前, since 以降)
+        ledger = self.ledgers.get(self._exchange_type)
+        if not ledger :
+            return None, None
+        return ledger[0], ledger[1](self, until, since)
+
+    def __ledger_bitflyer(self, until, since):
+        # 証拠金の変動履歴 (JPY)
+        before = None
+        while True:
+            params = {'count': 500}
+            if before :
+                params['before'] = before
+            res = self._api.private_get_getcollateralhistory(params)
+            if not res :
+                return
+            for r in res:
+                t = _parse_time(r['date'])
+                if t < since :
+                    return
+                if t < until and r['currency_code']=='JPY' :
+                    yield t, float(r['change'])
+            before = res[-1]['id']
+
+    def __ledger_bybit(self, until, since):
+        # ウォレットの入出金・損益の履歴 (BTC)
+        # 変化分は1つ古い記録の残高との差で求める (amount は種類によって符号が付かないため)
+        # 最も古い記録だけは差を取れないので、出金の種類は amount を負にする
+        page = 1
+        newer = None
+        end_date = datetime.utcfromtimestamp(until/1000).strftime('%Y-%m-%d')
+        while True:
+            res = self._api.v2_private_get_wallet_fund_records({'coin': 'BTC', 'end_date': end_date, 'page': page, 'limit': 50})['result']['data']
+            if not res :
+                break
+            for r in res:
+                t = _parse_time(r['exec_time'])
+                if newer :
+                    yield newer[0], newer[1]-float(r['wallet_balance'])
+                    newer = None
+                if t < since :
+                    return
+                if t < until :
+                    amount = float(r['amount'])
+                    newer = (t, float(r['wallet_balance']), -abs(amount) if r.get('type') in self.bybit_withdraw_types else amount)
+            page += 1
+        if newer :
+            yield newer[0], newer[2]
+
+    def __ledger_phemex(self, until, since, window=86400000):
+        # ccxtの入出金・損益の履歴 (BTC)
+        # 古い方からしか読めないので、1日ずつ新しい期間から順に読んで逆順に返す
+        window_end = until
+        while window_end > since :
+            window_start = max(since, window_end-window)
+            entries = []
+            cursor = window_start
+            while True:
+                res = self._api.fetch_ledger('BTC', cursor, 100)
+                res = [r for r in res if r['timestamp'] >= cursor]
+                if not res :
+                    break
+                entries += [(r['timestamp'], r['amount'] if r['direction']=='in' else -r['amount']) for r in res if r['timestamp'] < window_end]
+                if res[-1]['timestamp'] >= window_end :
+                    break
+                cursor = res[-1]['timestamp']+1
+            for entry in reversed(entries):
+                yield entry
+            window_end = window_start
+
+    def __ledger_gmo(self, until, since):
+        # 約定履歴の損益と手数料 (JPY, 取引所の制限で直近1日分のみ)
+        page = 1
+        while True:
+            res = self._api._get('/v1/latestExecutions', {'symbol': 'BTC_JPY', 'page': page, 'count': 100}).json().get('data',{}).get('list',[])
+            if not res :
+                return
+            for r in res:
+                t = _parse_time(r['timestamp'])
+                if t < since :
+                    return
+                if t < until :
+                    yield t, float(r['lossGain'])-float(r['fee'])
+            page += 1
+
+    # 取引所の種類毎の (API生成, 残高取得メソッド)
+    # API生成は設定されている種類についてだけ呼ばれるので、使わない取引所のモジュールは読み込まれない
+    adapters = {
+        'BF':       (lambda items: ccxt_api('bitflyer', items), __get_balance_bitflyer),
+        'Liquid':   (lambda items: ccxt_api('liquid', items),   __get_balance_liquid),
+        'BITMEX':   (lambda items: ccxt_api('bitmex', items),   __get_balance_bitmex),
+        'BYBIT':    (lambda items: ccxt_api('bybit', items),    __get_balance_bybit),
+#        'BTCMEX':   (lambda items: libs.ccxt.btcmex({'apiKey':items['apiKey'], 'secret':items['secret'], 'timeout':10000, 'options':{'api-expires':5}}), __get_balance_btcmex),
+        'PHEMEX':   (lambda items: ccxt_api('phemex', items),   __get_balance_phemex),
+        'GMO':      (lambda items: gmo_api(items['apiKey'], items['secret']), __get_balance_gmo),
+    }
+
+    # 取引所の種類毎に残高の計算に使うレート
+    required_rates = {
+        'BF':       ('btcjpy',),
+        'Liquid':   ('btcjpy',),
+        'BITMEX':   ('usdjpy', 'xbtusd'),
+        'BYBIT':    ('usdjpy', 'xbtusd'),
+        'BTCMEX':   ('usdjpy', 'xbtusd'),
+        'PHEMEX':   ('usdjpy', 'xbtusd', 'btcjpy'),
+        'GMO':      ('btcjpy',),
+    }
+
+    # Bybitの入出金・損益の履歴のうち、amount が正のまま残高が減る種類
+    bybit_withdraw_types = ('Withdraw', 'ExchangeOrderWithdraw')
+
+    # 履歴から作り直す balance のフィールドと履歴の取得メソッド
+    ledgers = {
+        'BF':       ('fixjpy', __ledger_bitflyer),
+        'BYBIT':    ('fixbtc', __ledger_bybit),
+        'PHEMEX':   ('fixbtc', __ledger_phemex),
+        'GMO':      ('fixjpy', __ledger_gmo),
+    }
+
+
+class balance_collector():
+    def __init__(self, logger, rate, db, workers=8, deadline=50, breaker_threshold=3, breaker_backoff=(30, 1800)):
+        self._logger = logger
+        self._rate = rate
+        self._db = db
+        self._deadline = deadline
+        self.__executor = ThreadPoolExecutor(max_workers=max(1,workers), thread_name_prefix='collector')
+        self.__running = {}
+        self.__breakers = {}
+        self.__breaker_threshold = breaker_threshold
+        self.__breaker_backoff = breaker_backoff
+
+    def __breaker(self, name):
+        if name not in self.__breakers :
+            self.__breakers[name] = circuit_breaker(self.__breaker_threshold, *self.__breaker_backoff)
+        return self.__breakers[name]
+
+    def allow(self, name):
+        # 失敗が続いて待機中の取引所には問い合わせない
+        return self.__breaker(name).allow()
+
+    def __collect_one(self, name, items, rate, timestamp):
+        # このスレッドでの通信やDB書き込みの時間を取引所毎に集計する
+        perf.set_group(name)
+        start = time.perf_counter()
+        # この取引所の通信は全て締め切りまでに終わらせる
+        _call_deadline.time = time.time()+self._deadline
+        result = None
+        try:
+            if 'exchange' not in items:
+                items['exchange'] = exchange(self._logger, name, items, self._rate, self._db)
+            result = items['exchange'].write_balance_to_db(rate, timestamp)
+            return result
+        finally:
+            _call_deadline.time = None
+            # 各取引所の残高取得はエラー時に空文字を返す (未対応の取引所ではメッセージを返す)。書き込んだ値が返ってきた時だけ成功
+            failed = not (result and isinstance(result[2], dict))
+            perf.add('collect', time.perf_counter()-start, error=failed)
+            perf.set_group('background')
+            self.__record(name, not failed)
+
+    def __record(self, name, success):
+        breaker = self.__breaker(name)
+        change = breaker.record(success)
+        if change=='open' :
+            self._logger.error("Stop requesting {} for {:.0f}sec after {} failures".format(name, breaker.open_until-time.time(), breaker.failures))
+            perf.count('circuit_opened')
+        elif change=='closed' :
+            self._logger.info("Resume requesting {}".format(name))
+
+    def submit(self, name, items, rate=None, timestamp=None):
+        # 1つの取引所の問い合わせを開始する
+        future = self.__executor.submit(self.__collect_one, name, items, rate, timestamp)
+        self.__running[name] = future
+        return future
+
+    def collect(self, exchange_list, rate=None):
+        # 全取引所へ並列に問い合わせて、全ての結果が揃う(もしくは締め切りを過ぎる)まで待つ
+        futures = {}
+        for name,items in exchange_list.items():
+            # 前のサイクルの問い合わせがまだ終わっていない取引所は今回はスキップ
+            running = self.__running.get(name)
+            if running and not running.done():
+                self._logger.error("Skip {} : previous request is still running".format(name))
+                perf.count('skipped')
+                continue
+            if not self.allow(name):
+                perf.count('circuit_skips')
+                continue
+            futures[self.submit(name, items, rate)] = name
+
+        done, not_done = wait(futures, timeout=self._deadline)
+
+        for future in not_done:
+            self._logger.error("Timeout while getting balance[{}] : {}sec".format(futures[future],self._deadline))
+            perf.count('timeouts')
+
+        # 設定ファイルの順番で結果を返す
+        results = {}
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                self._logger.error("Error while getting balance[{}] : {}".format(futures[future],e))
+                self._logger.info(traceback.format_exc())
+                perf.count('errors')
+        return dict([(name,results[name]) for name in exchange_list if name in results])
+
+
+class circuit_breaker():
+    # threshold回続けて失敗したら、backoff秒の間は問い合わせない
+    # 待機後の1回目も失敗したら待ち時間を倍にする (max_backoff秒まで)。成功したら元に戻す
+    def __init__(self, threshold=3, backoff=30, max_backoff=1800):
+        self.__threshold = threshold
+        self.__backoff = backoff
+        self.__max_backoff = max_backoff
+        self.__opened = 0
+        self.failures = 0
+        self.open_until = 0
+
+    def allow(self):
+        return time.time() >= self.open_until
+
+    def record(self, success):
+        # 状態が変わったら 'open' / 'closed' を返す
+        if success :
+            changed = self.failures >= self.__threshold
+            self.failures = 0
+            self.__opened = 0
+            self.open_until = 0
+            return 'closed' if changed else None
+        self.failures += 1
+        if self.failures < self.__threshold :
+            return None
+        self.open_until = time.time()+min(self.__max_backoff, self.__backoff*2**self.__opened)
+        self.__opened += 1
+        return 'open'
+
+
+class token_bucket():
+    # 取引所のレート制限 (rate回/秒、最大burst回まで連続可)
+    def __init__(self, rate, burst):
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = burst
+        self.__time = time.time()
+
+    def reserve(self, n):
+        # n回分を予約して、実行してよくなるまでの秒数を返す (足りない分は前借りする)
+        now = time.time()
+        self.__tokens = min(self.__burst, self.__tokens+(now-self.__time)*self.__rate)
+        self.__time = now
+        self.__tokens -= n
+        return max(0, -self.__tokens/self.__rate)
+
+
+class balance_scheduler():
+    # 取引所毎に設定された間隔で残高を取得する
+    #   ・取得は毎回同じ時刻にならないように取引所毎にずらして(jitter)行い、記録は区切りの時刻で行う
+    #   ・取引所の種類毎にレート制限を超えないように実行を遅らせる
+    #   ・取得が遅れて過ぎてしまった区切りは飛ばす (過去の残高は取得できないので、今の残高を過去の時刻で記録しない)
+    #   ・合計には取引所毎に直近に取得できた結果を使う (max_stale_cycles を指定したら、それより多く区切りを取得できていない取引所は除く)
+
+    # 1回の残高取得で使うリクエスト数
+    request_count = {'BF':4, 'Liquid':1, 'BITMEX':2, 'BYBIT':2, 'PHEMEX':2, 'GMO':2}
+    # 取引所の種類毎の既定のレート制限 (回/秒, 連続回数)
+    default_rate_limits = {'BF':(1.5, 20), 'Liquid':(1, 10), 'BITMEX':(1, 10), 'BYBIT':(10, 40), 'PHEMEX':(8, 40), 'GMO':(5, 10)}
+
+    def __init__(self, logger, collector, exchange_list, interval=60, jitter=10, rate_limits=None, deadline=50, max_stale_cycles=None):
+        self._logger = logger
+        self.__collector = collector
+        self.__max_stale_cycles = max_stale_cycles
+        self.__deadline = deadline
+        self.__queue = []
+        self.__jobs = {}
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+        self.__results = {}
+        self.__latest = {}
+        self.__latency = 0
+
+        limits = dict(self.default_rate_limits, **(rate_limits or {}))
+        now = time.time()
+        for name,items in exchange_list.items():
+            job_interval = items.get('interval', interval)
+            # 名前から決まる一定のずらし幅
+            offset = (zlib.crc32(name.encode('utf-8'))%1000)/1000*min(jitter, job_interval/2)
+            next_slot = (now//job_interval+1)*job_interval
+            self.__jobs[name] = {'items':items, 'interval':job_interval, 'offset':offset, 'next_slot':next_slot, 'future':None, 'reserved':False}
+            heapq.heappush(self.__queue, (next_slot+offset, name))
+            if items['type'] not in self.__buckets and items['type'] in limits :
+                self.__buckets[items['type']] = token_bucket(*limits[items['type']])
+
+    def run_until(self, deadline, rate=None):
+        # deadline まで、予定時刻になった取引所から順に取得を開始する (次の予定時刻までは眠る)
+        while True:
+            now = time.time()
+            while self.__queue and self.__queue[0][0] <= now :
+                run_time, name = heapq.heappop(self.__queue)
+                self.__dispatch(name, rate, now)
+            if now >= deadline :
+                return
+            next_time = min(self.__queue[0][0], deadline) if self.__queue else deadline
+            time.sleep(max(0, next_time-time.time()))
+
+    def __dispatch(self, name, rate, now):
+        job = self.__jobs[name]
+
+        # 前回の取得がまだ終わっていなければ終わるのを待つ
+        if job['future'] and not job['future'].done():
+            if now-job['started'] > self.__deadline and not job.get('timeout_logged'):
+                self._logger.error("Timeout while getting balance[{}] : {}sec".format(name, self.__deadline))
+                perf.count('timeouts')
+                job['timeout_logged'] = True
+            heapq.heappush(self.__queue, (now+1, name))
+            return
+
+        # 失敗が続いて待機中の取引所は、その間の区切りを飛ばす
+        if not self.__collector.allow(name) :
+            perf.count('circuit_skips')
+            job['next_slot'] = (now//job['interval']+1)*job['interval']
+            heapq.heappush(self.__queue, (job['next_slot']+job['offset'], name))
+            return
+
+        # レート制限を超えないように、必要なら実行を遅らせる
+        bucket = self.__buckets.get(job['items']['type'])
+        if bucket and not job['reserved'] :
+            wait = bucket.reserve(self.request_count.get(job['items']['type'], 1))
+            if wait > 0 :
+                job['reserved'] = True
+                heapq.heappush(self.__queue, (now+wait, name))
+                return
+        job['reserved'] = False
+
+        # 次の区切りを過ぎるほど遅れた場合は、過ぎた区切りを飛ばして今の区切りで記録する
+        slot = job['next_slot']
+        behind = int((now-slot)//job['interval'])
+        if behind > 0 :
+            self._logger.error("Skip {} slots of {}".format(behind, name))
+            perf.count('skipped', behind)
+            slot += behind*job['interval']
+
+        job['next_slot'] = slot+job['interval']
+        job['started'] = now
+        job['timeout_logged'] = False
+        job['future'] = self.__collector.submit(name, job['items'], rate, int(slot*1000))
+        job['future'].add_done_callback(lambda future: self.__on_done(name, slot, future))
+        heapq.heappush(self.__queue, (job['next_slot']+job['offset'], name))
+
+    def __on_done(self, name, slot, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self._logger.error("Error while getting balance[{}] : {}".format(name,e))
+            self._logger.info(traceback.format_exc())
+            perf.count('errors')
+            return
+        if result and result[2] and not isinstance(result[2], dict) :
+            self._logger.error("Error while getting balance[{}] : {}".format(name, result[2]))
+            perf.count('errors')
+        with self.__lock:
+            self.__results[name] = result
+            # 直近の結果は取得できた時だけ (区切りの時刻と一緒に) 残す
+            if result and isinstance(result[2], dict) :
+                self.__latest[name] = (result, slot)
+            # 予定時刻から取得完了までの時間
+            self.__latency = max(self.__latency, time.time()-slot)
+
+    def pop_results(self):
+        # 前回呼び出してから取得できた結果 (設定ファイルの順番) と、その中で予定時刻から最も遅れて完了するまでの秒数
+        with self.__lock:
+            results, self.__results = self.__results, {}
+            latency, self.__latency = self.__latency, 0
+        return dict([(name,results[name]) for name in self.__jobs if name in results]), latency
+
+    def latest_results(self):
+        # 全取引所の直近の結果 (合計の計算用。古すぎるものは除く)
+        # (古さは同じロックの中で計算する。間に最初の結果が届くと古さが分からない口座ができてしまうので)
+        with self.__lock:
+            stale = self.__staleness()
+            return dict([(name,self.__latest[name][0]) for name in self.__jobs if name in self.__latest and
+                         (self.__max_stale_cycles is None or stale[name] <= self.__max_stale_cycles)])
+
+    def staleness(self):
+        # 取引所毎に、直近の結果の後で取得できなかった区切りの数 (まだ1度も取得できていなければ None)
+        with self.__lock:
+            return self.__staleness()
+
+    def __staleness(self):
+        now = time.time()
+        return dict([(name, max(0, int((now-self.__latest[name][1])//job['interval'])-1) if name in self.__latest else None)
+                     for name,job in self.__jobs.items()])
+
+
+class balance_backfill():
+    # 取引所の履歴を新しい方へ向かって遡り、記録の無い期間の balance を1分毎に作り直す
+    # 最新の記録を起点に変化分を戻していき、記録の無い分 (前後 gap ミリ秒以内に記録が無い分) だけを書き込む
+    # 途中で止めても続きから再開できるように、書き込んだところまでを checkpoint_file に保存する
+    def __init__(self, logger, db, checkpoint_file='ProfitGraph_backfill.json', batch_size=5000, gap=120000):
+        self._logger = logger
+        self._db = db
+        self.__checkpoint_file = checkpoint_file
+        self.__batch_size = batch_size
+        self.__gap = gap
+        try:
+            with open(checkpoint_file, 'r', encoding='utf-8') as f:
+                self.__checkpoint = json.load(f)
+        except FileNotFoundError:
+            self.__checkpoint = {}
+
+    def run(self, exchange_list, since):
+        since = calendar.timegm(since.timetuple())*1000
+        for name,items in exchange_list.items():
+            if 'exchange' not in items :
+                continue
+            if self.__checkpoint.get(name,{}).get('done') :
+                self._logger.info("Skip {} : already backfilled (remove {} to run again)".format(name, self.__checkpoint_file))
+                continue
+            try:
+                self.__backfill(name, items['exchange'], since)
+            except Exception as e:
+                self._logger.exception("Error while backfilling {} : {}, {}".format(name, e, traceback.print_exc()))
+
+    def __backfill(self, name, ex, since):
+        state = self.__checkpoint.get(name)
+        if state :
+            # 前回の続きから
+            pending, balance, minute = state['pending'], state['balance'], state['minute']
+            until = minute+1
+        else:
+            # 最新の記録を起点にする
+            field, _ = ex.ledger_entries(0, 0)
+            if field is None :
+                self._logger.info("Skip {} : no ledger for {}".format(name, ex._exchange_type))
+                return
+            points = list(self._db.query('select last("{}") from "balance" where "exchange"=\'{}\''.format(field, name)).get_points())
+            if not points :
+                self._logger.error("Skip {} : no balance to start from".format(name))
+                return
+            pending = {'time': points[0]['time'], 'value': points[0]['last'], 'live': True}
+            balance = pending['value']
+            minute = (pending['time']+59999)//60000*60000
+            until = pending['time']+1
+        field, entries = ex.ledger_entries(until, since)
+
+        live = {}
+        live_times = []
+        live_from = None
+        lines = []
+        entry = next(entries, None)
+        minute -= 60000
+        while minute >= since :
+            # 既存の記録を1日分ずつ読み込む
+            if live_from is None or minute < live_from+self.__gap :
+                live_from = minute-86400000
+                result = self._db.query('select "{}" from "balance" where "exchange"=\'{}\' and time >= {}ms and time < {}ms'.format(
+                                        field, name, live_from-self.__gap, minute+60000+self.__gap))
+                live = dict([(p['time'], p[field]) for p in result.get_points() if p[field] is not None])
+                live_times = sorted(live)
+
+            # この分より後の変化を戻す (これより前に履歴が無ければ終わり)
+            undone = []
+            while entry is not None and entry[0] > minute :
+                balance -= entry[1]
+                undone.append(entry)
+                entry = next(entries, None)
+            if entry is None :
+                break
+
+            i = bisect.bisect_left(live_times, minute-self.__gap)
+            near = live_times[i:bisect.bisect_right(live_times, minute+self.__gap)]
+            inside = [t for t in near if minute <= t < min(minute+60000, pending['time'])]
+            if inside :
+                point = {'time': inside[-1], 'value': live[inside[-1]], 'live': True}
+                # 記録済みの点に着いたら、履歴に無い変化 (手数料など) がずれていかないように、その点の値から戻し直す
+                balance = point['value']-sum(amount for t,amount in undone if t <= point['time'])
+            elif not near :
+                point = {'time': minute, 'value': balance, 'live': False}
+            else:
+                point = None
+
+            # 1つ新しい点の変化分はこの点との差になる (記録済みの点どうしなら書き換えない)
+            if point :
+                if not (pending['live'] and point['live']) :
+                    lines.append(self.__line(name, field, pending, pending['value']-point['value']))
+                pending = point
+
+            if len(lines) >= self.__batch_size :
+                self.__write(name, lines, {'pending': pending, 'balance': balance, 'minute': minute})
+                lines = []
+            minute -= 60000
+
+        if not pending['live'] :
+            lines.append(self.__line(name, field, pending, 0))
+        self.__write(name, lines, {'done': True})
+
+    def __line(self, name, field, point, diff):
+        fields = {'diff_'+field: float(diff)}
+        if not point['live'] :
+            fields[field] = float(point['value'])
+        return line_protocol({"measurement": "balance", "tags": {'exchange': name}, "time": point['time'], "fields": fields})
+
+    def __write(self, name, lines, state):
+        if lines :
+            self._db.write_lines(lines)
+        self.__checkpoint[name] = state
+        tmp_file = self.__checkpoint_file+'.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.__checkpoint, f)
+        os.replace(tmp_file, self.__checkpoint_file)
+        self._logger.info("Backfill {} : {:,} points{}".format(name, len(lines), ' (done)' if state.get('done') else ''))
+
+
+class warm_state():
+    # 再起動直後のサイクルも普段と同じ速さで取得できるように、取得済みのレートとccxtの市場情報をサイクル毎にファイルに保存しておく
+    # 起動時には rates_ttl秒 / markets_ttl秒 以内に取得したものだけを使う
+    # (取引所毎の前回値は database が snapshot_file に保存している)
+    def __init__(self, logger, state_file='ProfitGraph_state.json', rates_ttl=120, markets_ttl=86400):
+        self._logger = logger
+        self.__state_file = state_file
+        self.__markets_json = {}
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        except Exception as e:
+            self._logger.error("Error while loading {} : {}".format(state_file, e))
+            state = {}
+
+        now = time.time()
+        self.rates = dict([(name,values) for name,values in state.get('rates',{}).items() if now-values['update_time'] < rates_ttl])
+        self.bitmex = state['bitmex'] if state.get('bitmex') and now-state['bitmex']['update_time'] < rates_ttl else None
+        for exchange_id,cache in state.get('markets',{}).items():
+            if now-cache['time'] < markets_ttl :
+                _markets_cache[exchange_id] = cache
+        if state :
+            self._logger.info("Load state from {} ({} rates, markets : {})".format(state_file, len(self.rates), ','.join(sorted(_markets_cache)) or 'none'))
+
+    def save(self, exchange_list, rate=None, bitmex=None):
+        try:
+            # 読み込み済みの市場情報を取引所の種類毎に1つだけ覚えておく
+            for items in exchange_list.values():
+                api = getattr(items.get('exchange'), '_api', None)
+                if getattr(api, 'markets', None) and api.id not in _markets_cache :
+                    _markets_cache[api.id] = {'time': time.time(), 'markets': api.markets, 'currencies': api.currencies}
+            # 市場情報は大きいので、JSONにするのは増えた時だけにして使い回す
+            for exchange_id,cache in _markets_cache.items():
+                if exchange_id not in self.__markets_json :
+                    self.__markets_json[exchange_id] = json.dumps(cache)
+
+            state = json.dumps({'time': time.time(), 'rates': rate.state() if rate else {}, 'bitmex': bitmex.state() if bitmex else None})
+            markets = ', '.join('{}: {}'.format(json.dumps(exchange_id), text) for exchange_id,text in self.__markets_json.items())
+
+            # 一時ファイルに書いてから置き換える
+            tmp_file = self.__state_file+'.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write('{}, "markets": {{{}}}}}'.format(state[:-1], markets))
+            os.replace(tmp_file, self.__state_file)
+        except Exception as e:
+            self._logger.error("Error while saving {} : {}".format(self.__state_file, e))
+
+
+def open_database(logger, settings, suffix=''):
+    # 複数プロセスで動かす場合は、スナップショットとスプールをプロセス毎に分ける
+    influx = settings.get('influxdb') or {}
+
+    # 圧縮モードでの書き込みの間隔は heartbeat を interval の倍数に切り上げた秒数になる
+    # それがダッシュボードのパネルの間隔より長いと、表示期間の始めの点が無い区間が欠ける
+    interval = settings.get('interval',60)
+    write_interval = -(-settings.get('heartbeat',database.dashboard_interval)//interval)*interval
+    if settings.get('compact_epsilon') is not None and write_interval > database.dashboard_interval :
+        logger.error("heartbeat writes every {}sec, longer than the dashboard interval {}sec. Panels may start with gaps".format(
+                     write_interval, database.dashboard_interval))
+
+    return database(logger=logger, host=influx.get('host','localhost') or '', port=influx.get('port',8086), database=influx.get('database','bots'),
+                  url=influx.get('url'), username=influx.get('username'), password=influx.get('password'),
+                  org=influx.get('org'), bucket=influx.get('bucket'), token=influx.get('token'),
+                  batch_size=settings.get('batch_size',1000), flush_interval=settings.get('flush_interval',5),
+                  compact_epsilon=settings.get('compact_epsilon'), heartbeat=settings.get('heartbeat',database.dashboard_interval), local_dir=settings.get('local_store','local_db'),
+                  snapshot_file='ProfitGraph_last_value{}.json'.format(suffix),
+                  spool_dir=settings.get('spool_dir','spool')+suffix, spool_max_size=settings.get('spool_max_mb',512)*1024*1024)
+
+
+def open_state(logger, settings, suffix=''):
+    return warm_state(logger, state_file='ProfitGraph_state{}.json'.format(suffix),
+                      rates_ttl=settings.get('state_rates_ttl',120), markets_ttl=settings.get('state_markets_ttl',86400))
+
+
+def shard_worker(shard, exchange_list, settings, snapshot_queue, result_queue):
+    # 担当する取引所の残高を取得して書き込み、サイクル毎の結果をコーディネーターへ送る
+    global session_timeout, http_hedge_after
+    session_timeout = tuple(settings.get('http_timeout', session_timeout))
+    http_hedge_after = settings.get('http_hedge_after')
+
+    logger = setup_logger()
+    perf.tags = {'shard': str(shard)}
+    db = open_database(logger, settings, '.shard{}'.format(shard))
+    state = open_state(logger, settings, '.shard{}'.format(shard))
+    for name,items in exchange_list.items():
+        try:
+            items['exchange'] = exchange(logger, name, items, None, db)
+        except Exception as e:
+            logger.error("Error while creating {} : {}".format(name, e))
+
+    collector = balance_collector(logger, None, db, workers=settings.get('workers',8), deadline=settings.get('deadline',50),
+                                  breaker_threshold=settings.get('breaker_threshold',3), breaker_backoff=settings.get('breaker_backoff',(30,1800)))
+    interval = settings.get('interval',60)
+    scheduler = balance_scheduler(logger, collector, exchange_list, interval=interval, jitter=settings.get('jitter',10),
+                                  rate_limits=settings.get('rate_limits'), deadline=settings.get('deadline',50),
+                                  max_stale_cycles=settings.get('max_stale_cycles'))
+    aggregator = portfolio(exchange_list)
+
+    # 最初のレートがコーディネーターから届くまでは取得を始めない (レートが無いと残高を計算できないので)
+    next_cycle = (time.time()//interval+1)*interval
+    snapshot = None
+    while True:
+        # コーディネーターから届くこのサイクルのレートを待つ (届かなければ前回のレートを使う)
+        timeout = None if snapshot is None else 5
+        try:
+            while True:
+                slot, values = snapshot_queue.get(timeout=timeout)
+                snapshot = rate_snapshot(**dict(values, age=MappingProxyType(values['age']), prices=MappingProxyType(values['prices'])))
+                if slot >= next_cycle :
+                    break
+        except queue.Empty:
+            logger.error("Shard {} : rates for this cycle have not arrived".format(shard))
+
+        scheduler.run_until(next_cycle+interval, snapshot)
+        results, latency = scheduler.pop_results()
+        perf.end_cycle(db, latency)
+        db.flush()
+        state.save(exchange_list)
+
+        latest = scheduler.latest_results()
+        result_queue.put({'shard': shard, 'slot': next_cycle, 'results': results,
+                          'total_balance': sum(r[0] for r in latest.values()), 'total_unreal': sum(r[1] for r in latest.values()),
+                          'cumulative': db.cumulative_total(), 'portfolio': aggregator.aggregate(latest, scheduler.staleness()), 'metrics': perf.metrics})
+        next_cycle += interval
+
+
+class shard_coordinator():
+    # 取引所を口座名のハッシュで shards 個のプロセスに振り分け、結果をまとめる (落ちたプロセスは再起動する)
+    def __init__(self, logger, exchange_list, settings, shards):
+        self._logger = logger
+        self.__settings = settings
+        self.__context = multiprocessing.get_context('spawn')
+        self.__result_queue = self.__context.Queue()
+        self.__markets = [{} for i in range(shards)]
+        for name,items in exchange_list.items():
+            self.__markets[zlib.crc32(name.encode('utf-8'))%shards][name] = items
+        self.__workers = [None]*shards
+        self.__snapshot_queues = [None]*shards
+        self.__reports = {}
+        for shard in range(shards):
+            self.__start(shard)
+
+    def __start(self, shard):
+        self.__snapshot_queues[shard] = self.__context.Queue()
+        self.__workers[shard] = self.__context.Process(target=shard_worker, name='shard{}'.format(shard), daemon=True,
+                                    args=(shard, self.__markets[shard], self.__settings, self.__snapshot_queues[shard], self.__result_queue))
+        self.__workers[shard].start()
+        self._logger.info("Start shard {} : {} exchanges (pid={})".format(shard, len(self.__markets[shard]), self.__workers[shard].pid))
+
+    def check_workers(self):
+        for shard,worker in enumerate(self.__workers):
+            if not worker.is_alive() :
+                self._logger.error("Shard {} exited (exitcode={}). Restarting".format(shard, worker.exitcode))
+                perf.count('shard_restarts')
+                self.__start(shard)
+
+    def send_snapshot(self, slot, snapshot):
+        values = dict(snapshot._asdict(), age=dict(snapshot.age), prices=dict(snapshot.prices))
+        for q in self.__snapshot_queues:
+            q.put((slot, values))
+
+    def gather(self, slot, deadline):
+        # 全てのプロセスからそのサイクルの結果が届くまで (最長 deadline まで) 待つ
+        results = {}
+        received = set()
+        while len(received) < len(self.__workers) and time.time() < deadline :
+            try:
+                report = self.__result_queue.get(timeout=max(0.1, deadline-time.time()))
+            except queue.Empty:
+                break
+            self.__reports[report['shard']] = report
+            results.update(report['results'])
+            if report['slot']==slot :
+                received.add(report['shard'])
+        if len(received) < len(self.__workers):
+            self._logger.error("Shards {} did not report in time".format(sorted(set(range(len(self.__workers)))-received)))
+        return results
+
+    def totals(self):
+        # 各プロセスの直近の報告から全体の合計を計算する
+        reports = self.__reports.values()
+        cumulative = dict([(key, sum(r['cumulative'].get(key,0) for r in reports)) for key in database.cumulative_keys])
+        return sum(r['total_balance'] for r in reports), sum(r['total_unreal'] for r in reports), cumulative, portfolio.combine(r['portfolio'] for r in reports)
+
+    def metrics(self):
+        # 各プロセスの直近の性能の集計 (Prometheusのテキスト形式)
+        return dict([(shard, r['metrics']) for shard,r in self.__reports.items()])
+
+
+class portfolio():
+    # 全取引所の直近の結果から、全体の資産とBTCの建玉 (デリバティブ+現物) を取引所の種類毎の内訳と一緒に集計する
+    # (ダッシュボードで取引所毎のシリーズをまとめ直さなくても済むように、サイクル毎に portfolio に書き込む)
+    keys = ('jpy', 'fixjpy', 'btc', 'fixbtc', 'pos', 'spot')
+    type_keys = ('jpy', 'btc', 'exposure')
+
+    def __init__(self, exchange_list):
+        self.__types = dict([(name, items['type'].lower()) for name,items in exchange_list.items()])
+
+    def aggregate(self, results, staleness=None):
+        # staleness を渡したら、前回の区切りの結果を取得できていない口座 (古い値を使っているか含めていない口座) の数も数える
+        fields = dict([(key,0.0) for key in self.keys+('exposure',)], accounts=0)
+        if staleness is not None :
+            fields['stale_accounts'] = sum(1 for missed in staleness.values() if missed!=0)
+        for name,(balance,unreal,db_str) in results.items():
+            # 取得できなかった口座 (エラー時の空文字や未対応の取引所のメッセージ) は含めない
+            if not isinstance(db_str, dict) :
+                continue
+            values = dict([(key,float(db_str.get(key,0))) for key in self.keys])
+            values['exposure'] = values['pos']+values['spot']
+            fields['accounts'] += 1
+            for key,val in values.items():
+                fields[key] += val
+            for key in self.type_keys:
+                type_key = self.__types[name]+'_'+key
+                fields[type_key] = fields.get(type_key,0.0)+values[key]
+        return fields
+
+    @staticmethod
+    def combine(parts):
+        # 複数プロセスで集計したものを合わせる (全て足し合わせられる値)
+        fields = {}
+        for part in parts:
+            for key,val in part.items():
+                fields[key] = fields.get(key,0)+val
+        return fields
+
+
+def print_summary(results, total_balance, total_unreal, snapshot):
+    for name,(balance,unreal,db_str) in results.items():
+        if db_str :
+            print( "Load collateral : {:>15} balance:{:>11.0f} unreal:{:>+6.0f} {}".format(name,balance,unreal,db_str) )
+    print( "Total : balance:{:>11.0f} unreal:{:>+6.0f}".format(total_balance,total_unreal) )
+    print( "Bitmex OI/OV = {:,.0f}/{:,.0f}".format(snapshot.open_interest, snapshot.open_value) )
+    if snapshot.btcjpy :
+        print( "bitFlyer FX/Spot = {:,.0f}/{:,.0f} : {:.1f}%".format(snapshot.fxbtcjpy, snapshot.btcjpy, (snapshot.fxbtcjpy-snapshot.btcjpy)/snapshot.btcjpy*100) )
+    else:
+        print( "bitFlyer FX/Spot = not available yet" )
+
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--build-rollups', metavar='YYYY-MM-DD', help='build hourly/daily rollups from existing balance history since the date (UTC) and exit')
+    parser.add_argument('--backfill', metavar='YYYY-MM-DD', help='rebuild balance history since the date (UTC) from exchange ledgers and exit')
+    parser.add_argument('--shards', type=int, help='number of worker processes (overrides settings: shards)')
+    args = parser.parse_args()
+
     parameters = yaml.safe_load(open('ProfitGraph.yaml', 'r', encoding='utf-8_sig') )
     exchange_list = parameters['markets']
+    settings = parameters.get('settings') or {}
 
     logger = setup_logger()
 
-    db = database(logger=logger, host='localhost', port=8086, database='bots')
+    session_timeout = tuple(settings.get('http_timeout', session_timeout))
+    http_hedge_after = settings.get('http_hedge_after')
+
+    shards = args.shards or settings.get('shards',1)
+
+    # 残高に含めるコインのレートが無ければ、毎サイクル失敗し続けるので起動しない
+    errors = exchange.check_coin_rates(exchange_list, set(exchange_rate.default_rates)|set(settings.get('rates') or {}))
+    for error in errors:
+        logger.error(error)
+    if errors :
+        sys.exit(1)
+
+    db = open_database(logger, settings, '.coordinator' if shards>1 else '')
 #    db = database(logger=logger)
 
-    rate = exchange_rate(logger, db)
-    bitmex = bitmex_info(logger, db)
+    if args.build_rollups :
+        db.build_rollups(_parse_date(args.build_rollups), datetime.now(timezone.utc))
+        sys.exit()
 
-    minutes_counter = -1
-    _today = '00'
+    if args.backfill :
+        for name,items in exchange_list.items():
+            try:
+                items['exchange'] = exchange(logger, name, items, None, db)
+            except Exception as e:
+                logger.error("Error while creating {} : {}".format(name, e))
+        balance_backfill(logger, db, batch_size=settings.get('batch_size',1000)*5).run(exchange_list, _parse_date(args.backfill))
+        sys.exit()
+
+    # 前回終了時のレートと市場情報を引き継ぐ
+    state = open_state(logger, settings, '.coordinator' if shards>1 else '')
+    rate = exchange_rate(logger, db, streaming=settings.get('streaming',False), stream_urls=settings.get('stream_urls'), rates=settings.get('rates'), saved=state.rates)
+    bitmex = bitmex_info(logger, db, saved=state.bitmex, rate=rate)
+
+    interval = settings.get('interval',60)
+
+    if shards > 1 :
+        # 取引所の取得は子プロセスで行い、ここではレートの配布と結果の集計だけを行う
+        perf.tags = {'shard': 'coordinator'}
+        coordinator = shard_coordinator(logger, exchange_list, settings, shards)
+        if not (rate.wait_ready(60) and bitmex.wait_ready(60)) :
+            logger.error("Some rates are not available yet")
+
+        if settings.get('prometheus_port') :
+            perf.start_http_server(settings['prometheus_port'])
+
+        next_cycle = (time.time()//interval+1)*interval
+        time.sleep(max(0, next_cycle-time.time()))
+        while True:
+            snapshot = rate.snapshot(bitmex)
+            coordinator.send_snapshot(next_cycle, snapshot)
+            coordinator.check_workers()
+
+            # 前のサイクルの結果をまとめる (区切りから全プロセスの結果が揃うまでの時間をサイクルの所要時間とする)
+            results = coordinator.gather(next_cycle-interval, time.time()+min(10, interval/2))
+            perf.end_cycle(db, time.time()-next_cycle)
+            perf.children = coordinator.metrics()
+            total_balance, total_unreal, cumulative, portfolio_fields = coordinator.totals()
+            db.write( measurement="balance_total", timestamp=int(next_cycle-interval)*1000,
+                      **dict([('cum_'+key,float(val)) for key,val in cumulative.items()]) )
+            if portfolio_fields :
+                db.write( measurement="portfolio", timestamp=int(next_cycle-interval)*1000, **portfolio_fields )
+            db.flush()
+            state.save({}, rate, bitmex)
+            print_summary(results, total_balance, total_unreal, snapshot)
+
+            next_cycle += interval
+            time.sleep(max(0, next_cycle-time.time()))
+
+    # 設定されている取引所のアダプタだけを読み込んで接続しておく
+    for name,items in exchange_list.items():
+        try:
+            items['exchange'] = exchange(logger, name, items, rate, db)
+        except Exception as e:
+            logger.error("Error while creating {} : {}".format(name, e))
+    max_rss = _max_rss_mb()
+    logger.info("Startup time : {:.2f}sec, maxrss : {}, adapters : {}".format(
+                time.perf_counter()-_startup_time, '{:.0f}MB'.format(max_rss) if max_rss is not None else 'n/a',
+                ','.join(sorted(set(items['type'] for items in exchange_list.values())))))
+
+    # 起動直後はレートが一通り揃うまで待つ
+    if not (rate.wait_ready(60) and bitmex.wait_ready(60)) :
+        logger.error("Some rates are not available yet")
+
+    if settings.get('prometheus_port') :
+        perf.start_http_server(settings['prometheus_port'])
+
+    collector = balance_collector(logger, rate, db, workers=settings.get('workers',8), deadline=settings.get('deadline',50),
+                                  breaker_threshold=settings.get('breaker_threshold',3), breaker_backoff=settings.get('breaker_backoff',(30,1800)))
+
+    scheduler = balance_scheduler(logger, collector, exchange_list, interval=interval, jitter=settings.get('jitter',10),
+                                  rate_limits=settings.get('rate_limits'), deadline=settings.get('deadline',50),
+                                  max_stale_cycles=settings.get('max_stale_cycles'))
+    aggregator = portfolio(exchange_list)
+
+    # 区切りの時刻毎にレートを固定し、次の区切りまで取引所毎の予定に従って取得してから結果をまとめる
+    next_cycle = (time.time()//interval+1)*interval
+    scheduler.run_until(next_cycle)
     while True:
-        time.sleep(1)
-        # ポジション履歴を 1 分毎に記録して保存
-        current_minutes = int(time.time() / 60)
-        if minutes_counter != current_minutes:
-            minutes_counter = current_minutes
-
-            total_balance = 0
-            total_unreal = 0
-            currenttime = (datetime.utcnow()+timedelta(hours=9)).timestamp()
-            message = ''
-            message_mex = ''
-            mex_usd_total = mex_positon_total = mex_unreal_total = 0
-
-            for name,items in exchange_list.items():
-                try:
-                    if 'exchange' not in items:
-                        items['exchange'] = exchange(logger, name, items, rate, db)
+        # このサイクルで全取引所が共通に使うレート
+        snapshot = rate.snapshot(bitmex)
+        scheduler.run_until(next_cycle+interval, snapshot)
 
-                    balance,unreal,db_str = items['exchange'].write_balance_to_db()
-                    if db_str :
-                        print( "Load collateral : {:>15} balance:{:>11.0f} unreal:{:>+6.0f} {}".format(name,balance,unreal,db_str) )
+        results, latency = scheduler.pop_results()
+        perf.end_cycle(db, latency)
 
-                except Exception as e:
-                    traceback.print_exc()
-            print( "Bitmex OI/OV = {:,.0f}/{:,.0f}".format(bitmex.open_interest, bitmex.open_value) )
-            print( "bitFlyer FX/Spot = {:,.0f}/{:,.0f} : {:.1f}%".format(rate.fxbtcjpy, rate.btcjpy, (rate.fxbtcjpy-rate.btcjpy)/rate.btcjpy*100) )
+        # 合計は各取引所の直近の結果から計算する
+        latest = scheduler.latest_results()
+        total_balance = sum(r[0] for r in latest.values())
+        total_unreal = sum(r[1] for r in latest.values())
+
+        # 全取引所の累積損益
+        db.write( measurement="balance_total", timestamp=int(next_cycle)*1000,
+                  **dict([('cum_'+key,float(val)) for key,val in db.cumulative_total().items()]) )
+
+        # 全取引所の資産と建玉の合計
+        db.write( measurement="portfolio", timestamp=int(next_cycle)*1000, **aggregator.aggregate(latest, scheduler.staleness()) )
+
+        # このサイクルのポイントをまとめて書き込む
+        db.flush()
+        state.save(exchange_list, rate, bitmex)
+
+        print_summary(results, total_balance, total_unreal, snapshot)
+        next_cycle += interval
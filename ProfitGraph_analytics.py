@@ -0,0 +1,200 @@
+# coding: utf-8
+#!/usr/bin/python3
+#
+# 残高の履歴から損益の指標を計算する
+#
+#   python ProfitGraph_analytics.py --dir export --resolution 3600
+#          (ProfitGraph_export.py で書き出したファイルを読む。--dir を付けなければ InfluxDB か --local-store の保存先から読む)
+#
+#   取引所毎と合計について 資産推移 / 最大ドローダウン / 期間毎のリターン / シャープレシオ
+#   / 価格変動による損益とトレードによる損益の内訳 / 価格差(FXと現物、BitMEXと国内)に対する建玉 を計算する
+#   全ての取引所を同じ時刻の列 (resolution秒毎) にそろえて、配列の演算だけで計算する
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import yaml
+
+import ProfitGraph
+import ProfitGraph_export
+
+# 計算に使う balance のフィールド
+balance_fields = ('jpy', 'btc', 'fixjpy', 'pos', 'spot')
+# 計算に使う価格 (measurement, フィールド)
+market_fields = {'xbtjpy': ('mex_market', 'xbtjpy'), 'btcjpy': ('bf_market', 'spot'), 'fxbtcjpy': ('bf_market', 'fx')}
+# 取引所の種類毎の建玉の価格 (これと現物価格との差が価格差に対する建玉になる)
+position_price = {'BF': 'fxbtcjpy', 'BITMEX': 'xbtjpy', 'BYBIT': 'xbtjpy', 'PHEMEX': 'xbtjpy', 'BTCMEX': 'xbtjpy'}
+
+
+def align_index(times, grid):
+    # 各時刻の直前の点の位置 (最初の点より前は -1)
+    return np.searchsorted(times, grid, side='right')-1
+
+
+def align(times, values, grid, index=None):
+    # 各時刻の直前の値で埋める (最初の値より前は NaN)
+    if index is None :
+        index = align_index(times, grid)
+    aligned = np.asarray(values, dtype=np.float64)[np.maximum(index, 0)] if len(values) else np.zeros(len(grid))
+    aligned[index < 0] = np.nan
+    return aligned
+
+
+def load_export(directory, names=None):
+    # 書き出したファイルから {取引所: {列名: 配列}} と {価格: (時刻, 値)} を読む
+    series = dict([(name, ProfitGraph_export.read_columns(directory, name)) for name in (names or ProfitGraph_export.exported_names(directory))])
+    markets = {}
+    for key,(measurement,field) in market_fields.items():
+        try:
+            columns = ProfitGraph_export.read_columns(directory, measurement, market=True)
+        except FileNotFoundError:
+            continue
+        if field in columns :
+            valid = ~np.isnan(columns[field])
+            markets[key] = (columns['time'][valid], columns[field][valid])
+    return series, markets
+
+
+def load_influx(db, start, end, resolution, names=None):
+    # InfluxDB から resolution 毎の最後の値を読む (点の数を減らすため集計はInfluxDBで行う)
+    # load_export() と同じく各時刻にはその時刻まで (その時刻を含む) の最後の値を使うように、
+    # 1ms ずらした期間 (t-resolution, t] で集計して、期間の終わりの時刻 t に付け直す
+    if names is None :
+        names = [p['value'] for p in db.query('show tag values from "balance" with key = "exchange"').get_points()]
+    group = 'time >= {}ms and time < {}ms group by time({}s, 1ms) fill(none)'.format(start-resolution*1000, end, resolution)
+    shift = resolution*1000-1
+    series = {}
+    for name in names:
+        points = list(db.query('select {} from "balance" where "exchange"=\'{}\' and {}'.format(
+                               ','.join('last("{0}") as "{0}"'.format(f) for f in balance_fields), name, group)).get_points())
+        columns = ProfitGraph_export.to_columns(points)
+        columns['time'] += shift
+        series[name] = columns
+    markets = {}
+    for key,(measurement,field) in market_fields.items():
+        points = list(db.query('select last("{}") as "value" from "{}" where {}'.format(field, measurement, group)).get_points())
+        if points :
+            columns = ProfitGraph_export.to_columns(points)
+            markets[key] = (columns['time']+shift, columns['value'])
+    return series, markets
+
+
+def drawdown(equity):
+    # 最大ドローダウン (金額と、その時点の最大資産に対する比率)
+    peak = np.fmax.accumulate(equity)
+    dd = equity-peak
+    if not np.any(~np.isnan(dd)) :
+        return 0.0, 0.0
+    i = np.nanargmin(dd)
+    return float(dd[i]), float(dd[i]/peak[i]) if peak[i] else 0.0
+
+
+def sharpe(equity, steps_per_day):
+    # 日次リターンから年率のシャープレシオ (リスクフリーレートは0)
+    daily = equity[::steps_per_day]
+    daily = daily[~np.isnan(daily)]
+    if len(daily) < 3 :
+        return float('nan')
+    returns = np.diff(daily)/np.abs(daily[:-1])
+    std = np.std(returns, ddof=1)
+    return float(np.mean(returns)/std*np.sqrt(365)) if std else float('nan')
+
+
+def analyze(series, markets, start, end, resolution=3600, types=None, window=86400):
+    # 全て resolution 秒毎の同じ時刻の列にそろえてから計算する
+    types = types or {}
+    grid = np.arange(start//(resolution*1000)*resolution*1000, end, resolution*1000, dtype=np.int64)
+    prices = dict([(key, align(t, v, grid)) for key,(t,v) in markets.items()])
+    spot_price = prices.get('btcjpy', prices.get('xbtjpy', np.full(len(grid), np.nan)))
+
+    result = {'time': grid, 'exchanges': {}}
+    fields = {}
+    for name,columns in series.items():
+        index = align_index(columns['time'], grid)
+        fields[name] = dict([(key, align(columns['time'], columns[key], grid, index) if key in columns else np.full(len(grid), np.nan))
+                             for key in balance_fields])
+    names = list(fields)
+
+    # 取引所 x 時刻 の行列にして計算する (値が無い所は0として合計する)
+    matrix = dict([(key, np.vstack([fields[name][key] for name in names]) if names else np.empty((0, len(grid)))) for key in balance_fields])
+    exposure = np.nan_to_num(matrix['pos'])+np.nan_to_num(matrix['spot'])
+    pnl = np.diff(matrix['jpy'], axis=1, prepend=np.nan)
+    # 1つ前の時点のBTCの量に価格の変化を掛けたものを価格変動による損益とする
+    price_pnl = np.hstack([np.zeros((len(names),1)), exposure[:,:-1]*np.diff(spot_price)])
+    trade_pnl = np.nan_to_num(pnl)-np.nan_to_num(price_pnl)
+    basis = np.vstack([np.nan_to_num(matrix['pos'][i])*(prices.get(position_price.get(types.get(name)), spot_price)-spot_price) for i,name in enumerate(names)]) \
+            if names else np.empty((0, len(grid)))
+
+    steps = max(1, window//resolution)
+    def summary(equity, price_pnl, trade_pnl, exposure, basis):
+        valid = equity[~np.isnan(equity)]
+        rolling = equity[steps:]-equity[:-steps] if len(equity) > steps else np.empty(0)
+        max_dd, max_dd_ratio = drawdown(equity)
+        return {'equity': equity,
+                'pnl': float(valid[-1]-valid[0]) if len(valid) else 0.0,
+                'max_drawdown': max_dd, 'max_drawdown_ratio': max_dd_ratio,
+                'rolling_return': rolling,
+                'sharpe': sharpe(equity, max(1, 86400//resolution)),
+                'price_pnl': float(np.nansum(price_pnl)), 'trade_pnl': float(np.nansum(trade_pnl)),
+                'exposure_btc': float(exposure[-1]) if len(exposure) else 0.0,
+                'basis_exposure': float(basis[-1]) if len(basis) else 0.0}
+
+    for i,name in enumerate(names):
+        result['exchanges'][name] = summary(matrix['jpy'][i], price_pnl[i], trade_pnl[i], exposure[i], basis[i])
+    total = np.where(np.all(np.isnan(matrix['jpy']), axis=0), np.nan, np.nansum(matrix['jpy'], axis=0)) if names else np.full(len(grid), np.nan)
+    result['total'] = summary(total, np.nansum(price_pnl, axis=0), trade_pnl.sum(axis=0), exposure.sum(axis=0), basis.sum(axis=0))
+    return result
+
+
+def print_result(result):
+    print("{:>20} {:>14} {:>14} {:>9} {:>7} {:>14} {:>14} {:>9} {:>12}".format(
+          'exchange', 'pnl', 'max_dd', 'max_dd%', 'sharpe', 'price_pnl', 'trade_pnl', 'pos_btc', 'basis'))
+    for name,r in list(result['exchanges'].items())+[('Total', result['total'])]:
+        print("{:>20} {:>14,.0f} {:>14,.0f} {:>8.1f}% {:>7.2f} {:>14,.0f} {:>14,.0f} {:>9.3f} {:>12,.0f}".format(
+              name, r['pnl'], r['max_drawdown'], r['max_drawdown_ratio']*100, r['sharpe'],
+              r['price_pnl'], r['trade_pnl'], r['exposure_btc'], r['basis_exposure']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='exported directory (reads from influxdb if omitted)')
+    parser.add_argument('--days', type=float, default=365, help='period to analyze')
+    parser.add_argument('--resolution', type=int, default=3600, help='seconds per step')
+    parser.add_argument('--window', type=int, default=86400, help='seconds for rolling returns')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='bots')
+    parser.add_argument('--local-store', help='read from the local store directory instead of influxdb')
+    args = parser.parse_args()
+
+    logger = ProfitGraph.setup_logger()
+    end = int(time.time()*1000)
+    start = end-int(args.days*86400000)
+
+    # 取引所の種類は設定ファイルから (価格差に対する建玉の計算に使う)
+    try:
+        types = dict([(name, items['type']) for name,items in yaml.safe_load(open('ProfitGraph.yaml', 'r', encoding='utf-8_sig'))['markets'].items()])
+    except Exception as e:
+        logger.error("Error while loading ProfitGraph.yaml : {}".format(e))
+        types = {}
+
+    load_start = time.perf_counter()
+    if args.dir :
+        series, markets = load_export(args.dir)
+    else:
+        # 読み込むだけなので、書き込み用の database (書き込みスレッドやスナップショット) は作らない
+        try:
+            db = ProfitGraph.database_reader(host='' if args.local_store else args.host, port=args.port, database=args.database, local_dir=args.local_store)
+            db.query('show measurements')
+        except Exception as e:
+            logger.error("Influxdb is not connected : {}".format(e))
+            sys.exit(1)
+        series, markets = load_influx(db, start, end, args.resolution)
+    analyze_start = time.perf_counter()
+    result = analyze(series, markets, start, end, args.resolution, types, args.window)
+    logger.info("Load {:.3f}sec, analyze {:.3f}sec ({} exchanges, {:,} steps)".format(
+                analyze_start-load_start, time.perf_counter()-analyze_start, len(series), len(result['time'])))
+    print_result(result)
@@ -0,0 +1,297 @@
+# coding: utf-8
+#!/usr/bin/python3
+#
+# 取引所とInfluxDBのスタブを使ったオフラインのベンチマーク
+#
+#   記録 : python ProfitGraph_bench.py record
+#          (ProfitGraph.yaml の口座で1サイクル分の応答を ProfitGraph_bench.json に記録する。APIキーや署名は保存しない)
+#   実行 : python ProfitGraph_bench.py run --latency 0.05 --accounts 1,10,100 --cycles 5 --interval 10
+#          (記録した応答をローカルのスタブサーバーから返し、口座数毎に本番と同じ balance_scheduler で interval 秒毎の区切りを
+#           cycles 回分取得して、区切りから取得完了までの時間などを計測する)
+#   ストリーミングの確認用に WebSocket のスタブ (websocket_stub) もある (settings の stream_urls で接続先にする)
+
+import argparse
+import base64
+import hashlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import os
+import socket
+import socketserver
+import struct
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import yaml
+
+import ProfitGraph
+
+recording_file = 'ProfitGraph_bench.json'
+
+# 署名や時刻など毎回変わるパラメータ (記録のキーには含めない)
+volatile_params = {'api_key', 'timestamp', 'sign', 'signature', 'recv_window', 'recvWindow', 'nonce', 'expires', 'from', 'to'}
+
+def request_key(method, url):
+    url = urllib.parse.urlsplit(url)
+    params = sorted((k,v) for k,v in urllib.parse.parse_qsl(url.query) if k not in volatile_params)
+    return '{} {}{}?{}'.format(method, url.netloc, url.path, urllib.parse.urlencode(params))
+
+
+class stub_server():
+    # 記録した応答を返すHTTPサーバー (latency秒遅らせて応答する)
+    def __init__(self, handler):
+        self.requests = 0
+        self.misses = 0
+        self.bytes_received = 0
+        self.__handler = handler
+        server = self
+
+        class request_handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.__respond()
+
+            def do_POST(self):
+                self.__respond()
+
+            def __respond(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+                server.requests += 1
+                server.bytes_received += len(body)
+                status, content_type, payload = server._stub_server__handler(self.command, self.path, body)
+                payload = payload.encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # クライアントが待ちきれずに切断した (タイムアウトやヘッジで捨てられた) 応答
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__httpd = ThreadingHTTPServer(('127.0.0.1', 0), request_handler)
+        self.__httpd.daemon_threads = True
+        self.port = self.__httpd.server_address[1]
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        threading.Thread(target=self.__httpd.serve_forever, daemon=True).start()
+
+
+class websocket_stub():
+    # ストリーミングのテスト用のWebSocketサーバー (ws://127.0.0.1:port/<名前>)
+    # 接続毎に messages(パス) が返すメッセージを interval秒毎に送り続ける (paused の間は何も送らない)
+    # disconnect() で全ての接続を切る。受信したメッセージは読み捨てる
+    def __init__(self, messages, interval=0.1):
+        self.connections = {}
+        self.paused = False
+        self.__messages = messages
+        self.__interval = interval
+        self.__sockets = []
+        server = self
+
+        class request_handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                # ハンドシェイク (RFC 6455)
+                request = b''
+                while b'\r\n\r\n' not in request :
+                    data = self.request.recv(4096)
+                    if not data :
+                        return
+                    request += data
+                lines = request.decode('latin-1').split('\r\n')
+                path = lines[0].split(' ')[1]
+                headers = dict([line.split(':',1) for line in lines[1:] if ':' in line])
+                key = dict([(k.strip().lower(),v.strip()) for k,v in headers.items()])['sec-websocket-key']
+                accept = base64.b64encode(hashlib.sha1((key+'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('ascii')).digest()).decode('ascii')
+                self.request.sendall('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n'.format(accept).encode('ascii'))
+                server.connections[path] = server.connections.get(path,0)+1
+                server._websocket_stub__sockets.append(self.request)
+
+                try:
+                    while True:
+                        if not server.paused :
+                            for message in server._websocket_stub__messages(path):
+                                self.request.sendall(server.frame(json.dumps(message)))
+                        time.sleep(server._websocket_stub__interval)
+                except OSError:
+                    pass
+
+        self.__server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), request_handler)
+        self.__server.daemon_threads = True
+        self.url = 'ws://127.0.0.1:{}'.format(self.__server.server_address[1])
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def frame(text):
+        # サーバーからのテキストフレーム (マスクしない)
+        payload = text.encode('utf-8')
+        if len(payload) < 126 :
+            header = struct.pack('!BB', 0x81, len(payload))
+        elif len(payload) < 65536 :
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, len(payload))
+        return header+payload
+
+    def disconnect(self):
+        sockets, self.__sockets = self.__sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+
+
+def exchange_stub(responses, latency):
+    # /<host>/<path>?<query> で届いたリクエストに記録した応答を返す
+    def handler(method, path, body):
+        time.sleep(latency)
+        res = responses.get(request_key(method, 'https:/'+path))
+        if res is None :
+            server.misses += 1
+            return 404, 'application/json', '{}'
+        return res['status'], res['content_type'], res['body']
+    server = stub_server(handler)
+    return server
+
+
+def influxdb_stub():
+    # 問い合わせには空の結果を返し、書き込みは受け取ったバイト数だけ数える
+    def handler(method, path, body):
+        if path.startswith('/write') or path.startswith('/api/v2/write'):
+            return 204, 'application/json', ''
+        return 200, 'application/json', '{"results":[{"statement_id":0}]}'
+    return stub_server(handler)
+
+
+def record(args):
+    parameters = yaml.safe_load(open('ProfitGraph.yaml', 'r', encoding='utf-8_sig') )
+    exchange_list = parameters['markets']
+    recording = {'accounts': dict([(name,{'type':items['type']}) for name,items in exchange_list.items()]), 'responses': {}}
+
+    def http_record(request, response):
+        recording['responses'].setdefault(request_key(request.method, request.url),
+                    {'status': response.status_code, 'content_type': response.headers.get('Content-Type','application/json'), 'body': response.text})
+    ProfitGraph.http_record = http_record
+
+    logger = ProfitGraph.setup_logger()
+    db = ProfitGraph.database(logger)   # 記録中はInfluxDBに書き込まない
+    rate = ProfitGraph.exchange_rate(logger, db)
+    bitmex = ProfitGraph.bitmex_info(logger, db, rate=rate)
+    rate.wait_ready(60)
+    bitmex.wait_ready(60)
+
+    # 本番と同じスケジューラで1区切り分を取得する (全口座の結果が揃うか、締め切りを過ぎるまで)
+    collector = ProfitGraph.balance_collector(logger, rate, db, deadline=args.interval)
+    scheduler = ProfitGraph.balance_scheduler(logger, collector, exchange_list, interval=args.interval, deadline=args.interval)
+    snapshot = rate.snapshot(bitmex)
+    received = {}
+    deadline = time.time()+args.interval*2
+    while len(received) < len(exchange_list) and time.time() < deadline :
+        scheduler.run_until(min(deadline, time.time()+1), snapshot)
+        received.update(scheduler.pop_results()[0])
+
+    with open(args.file, 'w', encoding='utf-8') as f:
+        json.dump(recording, f, indent=1)
+    logger.info("Recorded {} responses to {}".format(len(recording['responses']), args.file))
+
+
+def run_one(args):
+    recording = json.load(open(args.file, 'r', encoding='utf-8'))
+    exchange = exchange_stub(recording['responses'], args.latency)
+    influx = influxdb_stub()
+    ProfitGraph.http_redirect = exchange.url
+
+    # スナップショットやスプールは一時フォルダに作る
+    os.chdir(tempfile.mkdtemp(prefix='ProfitGraph_bench_'))
+
+    logger = ProfitGraph.setup_logger()
+    logger.handlers[0].setLevel(ProfitGraph.WARNING)
+    db = ProfitGraph.database(logger, host='127.0.0.1', port=influx.port, database='bench', spool_dir='spool')
+    rate = ProfitGraph.exchange_rate(logger, db)
+    bitmex = ProfitGraph.bitmex_info(logger, db, rate=rate)
+    rate.wait_ready(30)
+    bitmex.wait_ready(30)
+
+    # 記録した口座を複製して口座数を増やす
+    accounts = list(recording['accounts'].items())
+    exchange_list = {}
+    for i in range(args.accounts):
+        name, items = accounts[i%len(accounts)]
+        exchange_list['{}_{:03d}'.format(name,i)] = {'type': items['type'], 'apiKey': 'bench', 'secret': 'bench'}
+
+    # 本番のメインループと同じく、区切り毎にレートを固定してスケジューラで取得する
+    # (各区切りの時間は、区切りの時刻から最も遅れて取得が完了するまでの秒数)
+    collector = ProfitGraph.balance_collector(logger, rate, db, workers=args.workers, deadline=args.interval)
+    scheduler = ProfitGraph.balance_scheduler(logger, collector, exchange_list, interval=args.interval, deadline=args.interval)
+    latencies = []
+    requests = []
+    next_cycle = (time.time()//args.interval+1)*args.interval
+    scheduler.run_until(next_cycle)
+    for cycle in range(args.cycles):
+        count = exchange.requests
+        scheduler.run_until(next_cycle+args.interval, rate.snapshot(bitmex))
+        results, latency = scheduler.pop_results()
+        db.flush()
+        latencies.append(latency)
+        requests.append(exchange.requests-count)
+        next_cycle += args.interval
+    db.close()
+
+    # 1サイクル目は市場情報の読み込みなどが入るので別に集計する
+    steady = latencies[1:] or latencies
+    print(json.dumps({
+        'accounts': args.accounts,
+        'first_cycle': latencies[0],
+        'cycle_mean': statistics.mean(steady),
+        'cycle_max': max(steady),
+        'requests_per_cycle': statistics.mean(requests[1:] or requests),
+        'stub_misses': exchange.misses,
+        'bytes_written': influx.bytes_received,
+        'peak_rss_mb': ProfitGraph._max_rss_mb(),
+        }))
+
+
+def run(args):
+    # 最大メモリを口座数毎に測るため、1つずつ別プロセスで実行する
+    print("{:>8} {:>10} {:>10} {:>10} {:>10} {:>12} {:>10}".format('accounts','first[s]','mean[s]','max[s]','req/cycle','written[B]','rss[MB]'))
+    for accounts in [int(a) for a in args.accounts.split(',')]:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), 'run-one', '--file', os.path.abspath(args.file),
+                              '--accounts', str(accounts), '--latency', str(args.latency), '--cycles', str(args.cycles), '--workers', str(args.workers),
+                              '--interval', str(args.interval)],
+                             stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        r = json.loads(out.strip().splitlines()[-1])
+        # 最大メモリを取得できない環境 (Windows) では - を表示する
+        rss = '{:.1f}'.format(r['peak_rss_mb']) if r['peak_rss_mb'] is not None else '-'
+        print("{accounts:>8} {first_cycle:>10.3f} {cycle_mean:>10.3f} {cycle_max:>10.3f} {requests_per_cycle:>10.1f} {bytes_written:>12,} {rss:>10}".format(rss=rss, **r))
+        if r['stub_misses'] :
+            print("         ({} requests were not found in {})".format(r['stub_misses'], args.file))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['record', 'run', 'run-one'])
+    parser.add_argument('--file', default=recording_file, help='recorded responses')
+    parser.add_argument('--accounts', default='1,10,100', help='comma separated account counts (run) or an account count (run-one)')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub response latency in seconds')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--interval', type=float, default=10, help='seconds between slots (run/run-one) or to wait for responses (record)')
+    args = parser.parse_args()
+
+    if args.command=='record':
+        record(args)
+    elif args.command=='run':
+        run(args)
+    else:
+        args.accounts = int(args.accounts)
+        run_one(args)
@@ -0,0 +1,203 @@
+# coding: utf-8
+#!/usr/bin/python3
+#
+# InfluxDB の balance を取引所毎の列形式のファイルに書き出す (分析用)
+#
+#   書き出し : python ProfitGraph_export.py --dir export
+#              (前回書き出した時刻より後の分だけを期間を区切って問い合わせ、追記する)
+#              価格 (mex_market, bf_market) も export/_markets/<measurement>/ に書き出す
+#   形式     : npy     : export/<取引所>/<列名>.bin (time は int64 のミリ秒, 他は float64。値が無い所は NaN)
+#                        numpy.memmap で読める (read_columns() を使う)
+#              parquet : export/<取引所>/part-<開始時刻>.parquet (pyarrow が必要。追記毎にファイルを増やす)
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.parse
+
+import numpy as np
+
+import ProfitGraph
+
+meta_file = 'meta.json'
+chunk_days = 7
+markets_dir = '_markets'
+market_measurements = ('mex_market', 'bf_market')
+
+
+def exchange_dir(directory, name):
+    return os.path.join(directory, urllib.parse.quote(name, safe=''))
+
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, meta_file), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'rows': 0, 'last_time': None, 'columns': ['time'], 'format': None}
+
+
+def write_meta(path, meta):
+    tmp_file = os.path.join(path, meta_file+'.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(path, meta_file))
+
+
+def column_dtype(column):
+    return np.int64 if column=='time' else np.float64
+
+
+def exported_names(directory):
+    return sorted(urllib.parse.unquote(f) for f in os.listdir(directory) if f!=markets_dir and os.path.exists(os.path.join(directory, f, meta_file)))
+
+
+def read_columns(directory, name, market=False):
+    # 書き出した取引所 (market=True なら価格) の列を {列名: 配列} で返す
+    # (npy 形式はファイルをメモリにマップするだけで読み込まない)
+    path = os.path.join(directory, markets_dir, name) if market else exchange_dir(directory, name)
+    meta = read_meta(path)
+    if meta['format']=='parquet' :
+        # 後から増えた列は古い part には無いので NaN で埋めてつなげる
+        import pyarrow.parquet as pq
+        tables = [pq.read_table(os.path.join(path,f)) for f in sorted(os.listdir(path)) if f.endswith('.parquet')]
+        return dict([(column, np.concatenate([t.column(column).to_numpy() if column in t.column_names else np.full(t.num_rows, np.nan) for t in tables]
+                                             or [np.empty(0, dtype=column_dtype(column))])) for column in meta['columns']])
+    columns = {}
+    for column in meta['columns']:
+        if meta['rows'] :
+            columns[column] = np.memmap(os.path.join(path, column+'.bin'), dtype=column_dtype(column), mode='r', shape=(meta['rows'],))
+        else:
+            columns[column] = np.empty(0, dtype=column_dtype(column))
+    return columns
+
+
+class column_writer():
+    # 列毎のファイルに追記する (途中で落ちても meta.json の行数までは壊れない)
+    def __init__(self, path):
+        self.__path = path
+        self.meta = read_meta(path)
+        self.meta['format'] = 'npy'
+        # 前回 meta.json を書く前に落ちていたら、その分を切り捨てる
+        for column in self.meta['columns']:
+            file = os.path.join(path, column+'.bin')
+            if os.path.exists(file) :
+                os.truncate(file, self.meta['rows']*np.dtype(column_dtype(column)).itemsize)
+
+    def append(self, columns):
+        rows = len(columns['time'])
+        # 新しく出てきたフィールドはそれまでの行を NaN で埋めた列として作る
+        for column in columns:
+            if column not in self.meta['columns'] :
+                np.full(self.meta['rows'], np.nan).tofile(os.path.join(self.__path, column+'.bin'))
+                self.meta['columns'].append(column)
+        for column in self.meta['columns']:
+            values = columns.get(column)
+            if values is None :
+                values = np.full(rows, np.nan)
+            with open(os.path.join(self.__path, column+'.bin'), 'ab') as f:
+                f.write(np.asarray(values, dtype=column_dtype(column)).tobytes())
+        self.meta['rows'] += rows
+        self.meta['last_time'] = int(columns['time'][-1])
+        write_meta(self.__path, self.meta)
+
+
+class parquet_writer():
+    # 追記毎に1つの parquet ファイルを書く
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self.__pa = pyarrow
+        self.__pq = pyarrow.parquet
+        self.__path = path
+        self.meta = read_meta(path)
+        self.meta['format'] = 'parquet'
+
+    def append(self, columns):
+        for column in columns:
+            if column not in self.meta['columns'] :
+                self.meta['columns'].append(column)
+        # 列の揃っていない part は読み込み時にまとめられないので、これまでに出てきた列を全て書く
+        rows = len(columns['time'])
+        table = self.__pa.table(dict([(column, np.asarray(columns[column], dtype=column_dtype(column)) if column in columns else np.full(rows, np.nan))
+                                      for column in self.meta['columns']]))
+        tmp_file = os.path.join(self.__path, 'part.tmp')
+        self.__pq.write_table(table, tmp_file)
+        os.replace(tmp_file, os.path.join(self.__path, 'part-{:013d}.parquet'.format(int(columns['time'][0]))))
+        self.meta['rows'] += rows
+        self.meta['last_time'] = int(columns['time'][-1])
+        write_meta(self.__path, self.meta)
+
+
+def to_columns(points):
+    # 問い合わせ結果の点のリストを {列名: 配列} にする
+    columns = {'time': np.fromiter((p['time'] for p in points), dtype=np.int64, count=len(points))}
+    keys = set()
+    for p in points:
+        keys.update(p)
+    for key in sorted(keys-{'time', 'exchange'}):
+        columns[key] = np.fromiter((np.nan if p.get(key) is None else float(p[key]) for p in points), dtype=np.float64, count=len(points))
+    return columns
+
+
+def export_series(logger, db, path, fmt, end, measurement, where=None):
+    os.makedirs(path, exist_ok=True)
+    meta = read_meta(path)
+    if meta['rows'] and meta['format']!=fmt :
+        logger.error("Skip {} : already exported as {}".format(path, meta['format']))
+        return
+    writer = parquet_writer(path) if fmt=='parquet' else column_writer(path)
+
+    # 前回の続きから (初めてなら最初の点から)
+    start = writer.meta['last_time']
+    if start is None :
+        first = list(db.query('select * from "{}"{} order by time limit 1'.format(measurement, ' where '+where if where else '')).get_points())
+        if not first :
+            return
+        start = first[0]['time']-1
+
+    count = 0
+    while start < end :
+        chunk_end = min(start+chunk_days*86400000, end)
+        points = list(db.query('select * from "{}" where {}time > {}ms and time <= {}ms'.format(
+                                measurement, where+' and ' if where else '', start, chunk_end)).get_points())
+        if points :
+            writer.append(to_columns(points))
+            count += len(points)
+        start = chunk_end
+    logger.info("Export {} : {:,} rows (total {:,})".format(path, count, writer.meta['rows']))
+
+
+def export(logger, db, directory, fmt, end):
+    result = db.query('show tag values from "balance" with key = "exchange"')
+    for name in [p['value'] for p in result.get_points()]:
+        export_series(logger, db, exchange_dir(directory, name), fmt, end, 'balance', '"exchange"=\'{}\''.format(name))
+    for measurement in market_measurements:
+        export_series(logger, db, os.path.join(directory, markets_dir, measurement), fmt, end, measurement)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', default='export', help='output directory')
+    parser.add_argument('--format', choices=['npy', 'parquet'], default='npy')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='bots')
+    parser.add_argument('--local-store', help='read from the local store directory instead of influxdb')
+    args = parser.parse_args()
+
+    logger = ProfitGraph.setup_logger()
+    # 読み込むだけなので、書き込み用の database (書き込みスレッドやスナップショット) は作らない
+    try:
+        db = ProfitGraph.database_reader(host='' if args.local_store else args.host, port=args.port, database=args.database, local_dir=args.local_store)
+        db.query('show measurements')
+    except Exception as e:
+        logger.error("Influxdb is not connected : {}".format(e))
+        sys.exit(1)
+
+    # 書き込み途中の今の分は含めない
+    end = int(time.time()//60*60*1000)
+    export(logger, db, args.dir, args.format, end)
@@ -0,0 +1,647 @@
+# coding: utf-8
+#!/usr/bin/python3
+#
+# ProfitGraph.py のテスト (取引所やInfluxDBには接続しない)
+#
+#   python -m unittest test_ProfitGraph    (もしくは python -m pytest)
+
+import atexit
+import contextlib
+from concurrent.futures import Future
+import io
+import json
+import multiprocessing
+import os
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import unittest
+from types import MappingProxyType
+from unittest import mock
+
+import numpy as np
+
+import ProfitGraph
+import ProfitGraph_analytics
+import ProfitGraph_bench
+import ProfitGraph_export
+
+logger = ProfitGraph.setup_logger()
+logger.handlers[0].setLevel(ProfitGraph.ERROR+1)
+
+
+def make_snapshot(**rates):
+    values = dict(usdjpy=0, xbtusd=0, ethusd=0, btcjpy=0, fxbtcjpy=0, open_interest=0, open_value=0)
+    values.update(rates)
+    return ProfitGraph.rate_snapshot(age=MappingProxyType({}), prices=MappingProxyType(rates.get('prices',{})),
+                                     **dict([(k,v) for k,v in values.items() if k!='prices']))
+
+
+class stub_bitflyer():
+    # bitFlyer の残高取得で使う ccxt のメソッドだけ
+    def fetch_balance(self):
+        return {'info': [{'currency_code': 'JPY', 'amount': 1000}, {'currency_code': 'BTC', 'amount': 0.1}]}
+
+    def private_get_getcollateralaccounts(self):
+        return [{'currency_code': 'JPY', 'amount': 5000}]
+
+    def private_get_getcollateral(self):
+        return {'open_position_pnl': 10}
+
+    def private_get_getpositions(self, params):
+        return []
+
+
+class workdir_test(unittest.TestCase):
+    # スナップショットなどのファイルは一時フォルダに作る
+    def setUp(self):
+        self.__cwd = os.getcwd()
+        self.__tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.__tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.__cwd)
+        self.__tmp.cleanup()
+
+
+class rates_not_ready_test(workdir_test):
+    def make_exchange(self):
+        adapters = dict(ProfitGraph.exchange.adapters, BF=(lambda items: stub_bitflyer(), ProfitGraph.exchange.adapters['BF'][1]))
+        with mock.patch.object(ProfitGraph.exchange, 'adapters', adapters):
+            ex = ProfitGraph.exchange(logger, 'bf1', {'type': 'BF'}, None, ProfitGraph.database(logger))
+        ex.adapters = adapters
+        return ex
+
+    def test_skip_until_rates_are_ready(self):
+        ex = self.make_exchange()
+        self.assertEqual(ex.write_balance_to_db(make_snapshot(), 0), (0, 0, ""))
+        balance, unreal, db_str = ex.write_balance_to_db(make_snapshot(btcjpy=5000000, usdjpy=100, xbtusd=50000), 0)
+        self.assertEqual(balance, 1000+5000+0.1*5000000)
+        self.assertAlmostEqual(db_str['fixbtc'], balance/5000000)
+
+    def test_summary_without_rates(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            ProfitGraph.print_summary({'bf1': (0, 0, "")}, 0, 0, make_snapshot())
+        self.assertIn('not available', out.getvalue())
+
+
+
+class baseline_test(workdir_test):
+    # 前回値 (差分と累積の基準) をスナップショットと書き込み先のどちらから取るか
+    start = 1700000000000
+
+    def open_db(self, **kwargs):
+        return ProfitGraph.database(logger, local_dir='local_db', flush_interval=3600, **kwargs)
+
+    def write(self, db, *values):
+        for jpy in values:
+            self.start += 60000
+            db.write(measurement='balance', tags={'exchange': 'bf1'}, timestamp=self.start, jpy=jpy)
+        db.close()
+
+    def last_point(self, db):
+        return list(db.query('select "diff_jpy","cum_jpy" from "balance"').get_points())[-1]
+
+    def test_exchange_missing_from_snapshot(self):
+        self.write(self.open_db(), 100, 120)
+        os.remove('ProfitGraph_last_value.json')
+        db = self.open_db()
+        self.write(db, 130)
+        self.assertEqual(self.last_point(db), dict(time=self.start, diff_jpy=10, cum_jpy=30))
+
+    def test_warm_start_without_query(self):
+        # スナップショットは書き込む前に保存するので、書き込みの途中で落ちても書き込み先より古くならない
+        self.write(self.open_db(), 100, 120)
+        db = self.open_db()
+        with mock.patch.object(ProfitGraph.local_store, 'write_points', side_effect=ConnectionError):
+            self.write(db, 150)
+        # 書き込めないまま落ちたことにする (終了時に残りを書き込まない)
+        atexit.unregister(db.close)
+        # 再起動時は InfluxDB に問い合わせずにスナップショットの前回値を使う
+        with mock.patch.object(ProfitGraph.local_store, 'query', wraps=ProfitGraph.local_store.query, autospec=True) as query:
+            db = self.open_db()
+            self.write(db, 160)
+        self.assertEqual([c.args[1] for c in query.call_args_list], ['show measurements'])
+        self.assertEqual(self.last_point(db), dict(time=self.start, diff_jpy=10, cum_jpy=60))
+
+    def test_heartbeat_fills_dashboard_intervals(self):
+        # 変化が無くても、ダッシュボードのパネルの最小間隔毎に必ず点がある
+        db = self.open_db(compact_epsilon=1)
+        self.start = self.start//120000*120000-60000
+        self.write(db, *[100]*20)
+        counts = [p['count'] for p in db.query('select count("jpy") from "balance" group by time(120s)').get_points()]
+        self.assertEqual(counts, [1]*10)
+
+    def test_reconnect(self):
+        self.write(self.open_db(), 100, 120)
+        os.remove('ProfitGraph_last_value.json')
+        # 起動時に接続できなくても、再接続してから前回値を読み込んで差分を計算する
+        with mock.patch.object(ProfitGraph.local_store, 'query', side_effect=ConnectionError):
+            db = self.open_db(reconnect_interval=0)
+            self.write(db, 125, 130)
+        self.write(db)
+        self.assertEqual(self.last_point(db), dict(time=self.start, diff_jpy=5, cum_jpy=30))
+        diffs = [p['diff_jpy'] for p in db.query('select "diff_jpy" from "balance"').get_points()]
+        self.assertEqual(diffs, [0, 20, 5, 5])
+
+
+
+class write_spool_test(workdir_test):
+    def test_replay_order_and_partial_writes(self):
+        spool = ProfitGraph.write_spool(logger, 'spool', segment_size=1)
+        for lines in (['a 1'], ['b 2', 'b 3'], ['c 4']):
+            spool.append(lines)
+        # 追記の途中で落ちて最後の行が途切れた
+        with open(os.path.join('spool', sorted(os.listdir('spool'))[-1]), 'a', encoding='utf-8') as f:
+            f.write('d,exchange=bf1 jpy=')
+        spool = ProfitGraph.write_spool(logger, 'spool', segment_size=1)
+        spool.append(['e 5'])
+
+        # 途中で書き込めなくなったら、書き込めた分だけセグメントから除く
+        written = []
+        def write_lines(lines):
+            if fail and len(written)==2 :
+                raise ConnectionError
+            written.extend(lines)
+        fail = True
+        with self.assertRaises(ConnectionError):
+            spool.replay(write_lines, chunk_size=1)
+        fail = False
+        self.assertEqual(spool.replay(write_lines, chunk_size=1), 3)
+
+        # 古い順に1回ずつ書き込み、途切れた行は捨てる
+        self.assertEqual(written, ['a 1', 'b 2', 'b 3', 'c 4', 'e 5'])
+        self.assertEqual((spool.size(), os.listdir('spool')), (0, []))
+
+
+class local_store_test(workdir_test):
+    def test_concurrent_writers(self):
+        # 別々のプロセス (ここでは別々のインスタンス) が同じシリーズに追記しても列の長さが揃ったまま
+        def write(store, offset):
+            for i in range(100):
+                store.write_points(['profitgraph_perf,group=cycle count={}i,elapsed={} {}'.format(i, offset, 1700000000000+offset+i*10)], protocol='line')
+        threads = [threading.Thread(target=write, args=(ProfitGraph.local_store('local_db'), offset)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        points = list(ProfitGraph.local_store('local_db').query('select "count","elapsed" from "profitgraph_perf"').get_points())
+        self.assertEqual(len(points), 400)
+        self.assertEqual(sorted((p['time']-1700000000000)%10 for p in points), sorted([p['elapsed'] for p in points]))
+
+
+
+class perf_monitor_test(workdir_test):
+    def test_shards_write_separate_series(self):
+        db = ProfitGraph.database(logger, local_dir='local_db', flush_interval=3600)
+        coordinator = ProfitGraph.perf_monitor()
+        coordinator.tags = {'shard': 'coordinator'}
+        for shard in ('0', '1'):
+            monitor = ProfitGraph.perf_monitor()
+            monitor.tags = {'shard': shard}
+            monitor.add('api', 0.5, group='bf1')
+            monitor.end_cycle(db, 1.0)
+            coordinator.children[shard] = monitor.metrics
+        coordinator.end_cycle(db, 2.0)
+        db.close()
+
+        result = db.query('select count("elapsed") from "profitgraph_perf" where "span"=\'cycle\' group by "shard"')
+        self.assertEqual(sorted(tags['shard'] for (measurement, tags), points in result.items()), ['0', '1', 'coordinator'])
+        lines = coordinator.exposition().splitlines()
+        self.assertEqual(lines[:3], ['profitgraph_cycle_seconds{shard="coordinator"} 2.0',
+                                     'profitgraph_cycle_seconds{shard="0"} 1.0', 'profitgraph_cycle_seconds{shard="1"} 1.0'])
+        self.assertIn('profitgraph_span_count{shard="1",group="bf1",span="api"} 1', lines)
+
+
+
+class shard_coordinator_test(workdir_test):
+    def tearDown(self):
+        for worker in multiprocessing.active_children():
+            worker.terminate()
+            worker.join()
+        super().tearDown()
+
+    def worker(self, name):
+        return [p for p in multiprocessing.active_children() if p.name==name][0]
+
+    def test_restart_dead_worker(self):
+        coordinator = ProfitGraph.shard_coordinator(logger, {'bf1': {'type': 'BF'}, 'bf2': {'type': 'BF'}}, {'interval': 1}, 2)
+        worker = self.worker('shard1')
+        worker.kill()
+        worker.join()
+
+        # 落ちたプロセスだけを同じ担当のまま起動し直す
+        shard0 = self.worker('shard0')
+        coordinator.check_workers()
+        self.assertIs(self.worker('shard0'), shard0)
+        restarted = self.worker('shard1')
+        self.assertNotEqual(restarted.pid, worker.pid)
+        self.assertTrue(restarted.is_alive())
+
+        # 起動し直したプロセスもレートを受け取って結果を報告する
+        coordinator.send_snapshot(time.time()+60, make_snapshot(usdjpy=150, xbtusd=50000))
+        deadline = time.time()+30
+        while 1 not in coordinator.metrics() and time.time() < deadline :
+            coordinator.gather(0, time.time()+0.5)
+        self.assertIn(1, coordinator.metrics())
+
+
+class line_protocol_test(unittest.TestCase):
+    def test_skip_non_finite_fields(self):
+        # nan/inf があると InfluxDB がまとめて拒否するので、そのフィールドだけ書き込まない
+        point = {'measurement': 'balance', 'tags': {'exchange': 'bf1'}, 'time': 1000,
+                 'fields': {'jpy': 100.0, 'btc': float('nan'), 'pos': float('inf'), 'spot': float('-inf'), 'count': 1}}
+        self.assertEqual(ProfitGraph.line_protocol(point), 'balance,exchange=bf1 jpy=100.0,count=1i 1000')
+
+
+class stub_collector():
+    # 口座毎に決めた結果を順番に返す (残りは失敗)
+    def __init__(self, results):
+        self.results = results
+        self.timestamps = {}
+
+    def allow(self, name):
+        return True
+
+    def submit(self, name, items, rate, timestamp):
+        self.timestamps.setdefault(name, []).append(timestamp)
+        future = Future()
+        future.set_result(self.results[name].pop(0) if self.results[name] else (0, 0, ""))
+        return future
+
+
+class latest_results_test(unittest.TestCase):
+    def test_failures_keep_last_good_value(self):
+        good = (100, 0, {'jpy': 100, 'btc': 0.01})
+        exchange_list = {'bf1': {'type': 'BF'}, 'bf2': {'type': 'BF'}}
+        scheduler = ProfitGraph.balance_scheduler(logger, stub_collector({'bf1': [good], 'bf2': []}), exchange_list,
+                                                  interval=0.1, jitter=0, rate_limits={'BF': (1000, 1000)}, max_stale_cycles=2)
+        aggregator = ProfitGraph.portfolio(exchange_list)
+        scheduler.run_until(time.time()+0.15)
+        self.assertEqual(scheduler.latest_results(), {'bf1': good})
+        self.assertEqual(scheduler.staleness()['bf2'], None)
+        self.assertEqual(aggregator.aggregate(scheduler.latest_results(), scheduler.staleness())['accounts'], 1)
+
+        # 失敗が続いても直近の値を使い、区切りを max_stale_cycles より多く取得できなければ合計から除く
+        scheduler.run_until(time.time()+0.12)
+        self.assertEqual(scheduler.latest_results(), {'bf1': good})
+        scheduler.run_until(time.time()+0.3)
+        self.assertGreater(scheduler.staleness()['bf1'], 2)
+        self.assertEqual(scheduler.latest_results(), {})
+        fields = aggregator.aggregate(scheduler.latest_results(), scheduler.staleness())
+        self.assertEqual((fields['accounts'], fields['stale_accounts']), (0, 2))
+
+    def test_unsupported_exchange_is_not_a_result(self):
+        # 未対応の取引所のメッセージは結果として扱わない (合計で落ちないように)
+        unsupported = (0, 0, "Unsupported exchange : BTCMEX")
+        exchange_list = {'mex1': {'type': 'BTCMEX'}}
+        scheduler = ProfitGraph.balance_scheduler(logger, stub_collector({'mex1': [unsupported]*5}), exchange_list, interval=0.1, jitter=0)
+        scheduler.run_until(time.time()+0.15)
+        self.assertEqual(scheduler.pop_results()[0], {'mex1': unsupported})
+        self.assertEqual(scheduler.latest_results(), {})
+        self.assertEqual(ProfitGraph.portfolio(exchange_list).aggregate({'mex1': unsupported})['accounts'], 0)
+
+
+class stub_unsupported():
+    def write_balance_to_db(self, rate=None, timestamp=None):
+        return 0, 0, "Unsupported exchange : BTCMEX"
+
+
+class scheduler_test(unittest.TestCase):
+    def test_unsupported_exchange_opens_breaker(self):
+        # 未対応の取引所は成功として扱わず、失敗が続いたら問い合わせを止める
+        collector = ProfitGraph.balance_collector(logger, None, None, breaker_threshold=2)
+        items = {'type': 'BTCMEX', 'exchange': stub_unsupported()}
+        for i in range(2):
+            self.assertTrue(collector.allow('mex1'))
+            collector.submit('mex1', items).result()
+        self.assertFalse(collector.allow('mex1'))
+
+    def test_missed_slots_are_skipped(self):
+        # 遅れて過ぎてしまった区切りは取り戻さずに、今の区切りで記録する
+        collector = stub_collector({'bf1': []})
+        scheduler = ProfitGraph.balance_scheduler(logger, collector, {'bf1': {'type': 'BF'}}, interval=0.1, jitter=0,
+                                                  rate_limits={'BF': (1000, 1000)})
+        scheduler.run_until(time.time()+0.15)
+        count = len(collector.timestamps['bf1'])
+        time.sleep(0.35)
+        now = time.time()
+        scheduler.run_until(now)
+        timestamps = collector.timestamps['bf1']
+        self.assertEqual(len(timestamps), count+1)
+        self.assertGreater(timestamps[-1]-timestamps[-2], 250)
+        self.assertAlmostEqual(timestamps[-1], now//0.1*0.1*1000, delta=1)
+
+
+class token_bucket_test(unittest.TestCase):
+    def test_reserve(self):
+        # burst回までは待たずに実行でき、その後は rate回/秒に合わせて待つ (足りない分は前借りする)
+        bucket = ProfitGraph.token_bucket(rate=10, burst=2)
+        self.assertEqual([bucket.reserve(1), bucket.reserve(1)], [0, 0])
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, delta=0.02)
+        self.assertAlmostEqual(bucket.reserve(2), 0.3, delta=0.02)
+        # 待っている間に回復するが、burst回より多くはたまらない
+        time.sleep(1)
+        self.assertEqual([bucket.reserve(1), bucket.reserve(1)], [0, 0])
+        self.assertAlmostEqual(bucket.reserve(1), 0.1, delta=0.02)
+
+
+class circuit_breaker_test(unittest.TestCase):
+    def test_open_and_half_open(self):
+        breaker = ProfitGraph.circuit_breaker(threshold=2, backoff=0.2, max_backoff=0.3)
+        self.assertIsNone(breaker.record(False))
+        self.assertTrue(breaker.allow())
+        # threshold回続けて失敗したら backoff秒の間は問い合わせない
+        self.assertEqual(breaker.record(False), 'open')
+        self.assertFalse(breaker.allow())
+        self.assertAlmostEqual(breaker.open_until-time.time(), 0.2, delta=0.05)
+        time.sleep(0.25)
+        # 待機後の1回目 (half-open) も失敗したら待ち時間を倍にする (max_backoff秒まで)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.record(False), 'open')
+        self.assertAlmostEqual(breaker.open_until-time.time(), 0.3, delta=0.05)
+        time.sleep(0.35)
+        # 成功したら元に戻る
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.record(True), 'closed')
+        self.assertEqual(breaker.failures, 0)
+        self.assertIsNone(breaker.record(False))
+        self.assertTrue(breaker.allow())
+
+
+class http_session_test(unittest.TestCase):
+    def tearDown(self):
+        ProfitGraph._call_deadline.time = None
+
+    def slow_server(self, delays):
+        # 届いた順に delays 秒待ってから、何番目のリクエストかを返す
+        calls = []
+        lock = threading.Lock()
+        def handler(method, path, body):
+            with lock:
+                calls.append(path)
+                n = len(calls)
+            time.sleep(delays[n-1] if n <= len(delays) else 0)
+            return 200, 'text/plain', str(n)
+        return ProfitGraph_bench.stub_server(handler), calls
+
+    def test_hedged_get(self):
+        # 応答が hedge_after 秒までに無ければ同じGETをもう1つ送り、早く返った方を使う
+        server, calls = self.slow_server([2, 0])
+        session = ProfitGraph.http_session((5, 5), hedge_after=0.1, redirect=False)
+        start = time.time()
+        response = session.get(server.url+'/ticker')
+        self.assertLess(time.time()-start, 1)
+        self.assertEqual((response.text, len(calls)), ('2', 2))
+
+        # 間に合えばもう1つは送らない
+        server, calls = self.slow_server([0])
+        self.assertEqual(session.get(server.url+'/ticker').text, '1')
+        time.sleep(0.2)
+        self.assertEqual(len(calls), 1)
+
+    def test_call_deadline(self):
+        # 残高取得の締め切りを超えないようにタイムアウトを縮める
+        server, calls = self.slow_server([2])
+        session = ProfitGraph.http_session((5, 5), redirect=False)
+        ProfitGraph._call_deadline.time = time.time()+0.2
+        start = time.time()
+        with self.assertRaises(ProfitGraph.Timeout):
+            session.get(server.url+'/balance')
+        self.assertLess(time.time()-start, 1)
+
+        # 締め切りを過ぎていたら送らない
+        with self.assertRaises(ProfitGraph.Timeout):
+            session.get(server.url+'/balance')
+        self.assertEqual(len(calls), 1)
+
+
+
+class loaders_test(workdir_test):
+    def test_influx_and_export_agree(self):
+        # 書き出したファイルから読んでも InfluxDB で集計して読んでも、各時刻にはその時刻までの最後の値を使う
+        base = 1700000000000//3600000*3600000
+        store = ProfitGraph.local_store('local_db')
+        store.write_points(['balance,exchange=bf1 jpy={},btc={},pos={},spot=0,fixjpy=0 {}'.format(1000+i*i, 0.01*i, 0.001*(i%7), base+i*60000) for i in range(240)]+
+                           ['bf_market spot={},fx={} {}'.format(5000000+i*100, 5010000+i*90, base+30000+i*60000) for i in range(240)], protocol='line')
+        end = base+240*60000
+        reader = ProfitGraph.database_reader(local_dir='local_db')
+        ProfitGraph_export.export(logger, reader, 'export', 'npy', end)
+
+        start = base+1800000
+        results = [ProfitGraph_analytics.analyze(*loaded, start, end, resolution=600, types={'bf1': 'BF'}) for loaded in
+                   (ProfitGraph_analytics.load_export('export'), ProfitGraph_analytics.load_influx(reader, start, end, 600))]
+        for key in ('equity', 'price_pnl', 'trade_pnl'):
+            np.testing.assert_array_equal(results[0]['exchanges']['bf1'][key], results[1]['exchanges']['bf1'][key])
+        self.assertEqual(results[1]['exchanges']['bf1']['equity'][0], 1000+30*30)
+
+    def test_export_is_read_only(self):
+        # 書き出しでは書き込み用の database (書き込みスレッドやスナップショット、スプール) を作らない
+        ProfitGraph.local_store('local_db').write_points(['balance,exchange=bf1 jpy=1 1700000000000'], protocol='line')
+        with mock.patch.object(ProfitGraph, 'database', side_effect=AssertionError("database is for writing")), \
+             mock.patch.object(ProfitGraph, 'setup_logger', return_value=logger), \
+             mock.patch.object(sys, 'argv', ['ProfitGraph_export.py', '--dir', 'export', '--local-store', 'local_db']):
+            runpy.run_path(ProfitGraph_export.__file__, run_name='__main__')
+        self.assertEqual(sorted(os.listdir('.')), ['export', 'local_db'])
+        self.assertEqual(ProfitGraph_export.read_columns('export', 'bf1')['jpy'].tolist(), [1])
+
+
+
+class stub_ledger():
+    # 履歴から作り直す取引所 (新しい順に (時刻, 変化分) を返す)
+    _exchange_type = 'BF'
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def ledger_entries(self, until, since):
+        return 'fixjpy', iter([(t, amount) for t,amount in self.entries if since <= t < until])
+
+
+class stub_bybit():
+    def __init__(self, records=()):
+        self.pages = [list(records), []]
+
+    def v2_private_get_wallet_fund_records(self, params):
+        return {'result': {'data': self.pages[params['page']-1]}}
+
+    def v2_private_get_wallet_balance(self):
+        return {'result': {'BTC': {'wallet_balance': 0.5, 'unrealised_pnl': 0}, 'ETH': {'wallet_balance': 10, 'unrealised_pnl': 0}}}
+
+    def v2_private_get_position_list(self, params):
+        return {'result': {'size': 0, 'side': 'None', 'entry_price': 0}}
+
+
+class backfill_test(workdir_test):
+    def test_reanchor_to_live_points(self):
+        # 記録済みの点に着いたら、その値から戻し直す (履歴に無い変化の分だけずれたままにしない)
+        latest = 1700000000000//60000*60000
+        db = ProfitGraph.database(logger, local_dir='local_db', flush_interval=3600)
+        db.write_lines(['balance,exchange=bf1 fixjpy=100 {}'.format(latest-600000), 'balance,exchange=bf1 fixjpy=130 {}'.format(latest)])
+        ex = stub_ledger([(latest-330000, 20), (latest-750000, 10), (latest-1170000, 5)])
+        backfill = ProfitGraph.balance_backfill(logger, db)
+        backfill.run({'bf1': {'exchange': ex}}, ProfitGraph.datetime.utcfromtimestamp((latest-1200000)/1000))
+        points = dict((p['time'], p['fixjpy']) for p in db.query('select "fixjpy" from "balance"').get_points())
+        self.assertEqual(points[latest-360000], 110)
+        self.assertEqual(points[latest-900000], 90)
+        self.assertEqual(points[latest-1140000], 90)
+
+    def test_bybit_oldest_withdrawal_is_negative(self):
+        records = [{'exec_time': '2023-11-14T22:10:00Z', 'wallet_balance': '1.0', 'amount': '0.25', 'type': 'RealisedPNL'},
+                   {'exec_time': '2023-11-14T22:00:00Z', 'wallet_balance': '0.75', 'amount': '0.5', 'type': 'Withdraw'}]
+        adapters = dict(ProfitGraph.exchange.adapters, BYBIT=(lambda items: stub_bybit(records), ProfitGraph.exchange.adapters['BYBIT'][1]))
+        with mock.patch.object(ProfitGraph.exchange, 'adapters', adapters):
+            ex = ProfitGraph.exchange(logger, 'bybit1', {'type': 'BYBIT'}, None, ProfitGraph.database(logger))
+        field, entries = ex.ledger_entries(1800000000000, 0)
+        self.assertEqual([amount for t,amount in entries], [0.25, -0.5])
+
+
+
+class build_rollups_test(workdir_test):
+    def setUp(self):
+        super().setUp()
+        # 日本時間のPCでも期間はUTCで区切る
+        self.__tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Asia/Tokyo'
+        time.tzset()
+
+    def tearDown(self):
+        if self.__tz is None :
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.__tz
+        time.tzset()
+        super().tearDown()
+
+    def test_utc_range_and_cumulative(self):
+        queries = []
+        def handler(method, path, body):
+            query = urllib.parse.parse_qs(body.decode('utf-8')).get('q', [''])[0]
+            queries.append(query)
+            if query.startswith('show field keys') :
+                values = [[key, 'float'] for key in ('jpy', 'btc', 'pos', 'diff_jpy', 'cum_jpy')]
+                return 200, 'application/json', json.dumps({'results': [{'series': [{'name': 'balance', 'columns': ['fieldKey', 'fieldType'], 'values': values}]}]})
+            return 200, 'application/json', '{"results":[{"statement_id":0}]}'
+        server = ProfitGraph_bench.stub_server(handler)
+        db = ProfitGraph.database(logger, url=server.url, database='bots', flush_interval=3600)
+        start = ProfitGraph._parse_date('2024-01-01')
+        db.build_rollups(start, start+ProfitGraph.timedelta(days=1))
+        selects = [q for q in queries if q.startswith('select') and ' into "balance_1h"' in q]
+        self.assertEqual(len(selects), 1)
+        self.assertIn('time >= 1704067200s and time < 1704153600s', selects[0])
+        self.assertIn('last("jpy") as "jpy"', selects[0])
+        self.assertIn('sum("diff_jpy") as "diff_jpy"', selects[0])
+        self.assertIn('last("cum_jpy") as "cum_jpy"', selects[0])
+
+
+
+class bitmex_instrument_test(unittest.TestCase):
+    def tearDown(self):
+        ProfitGraph.http_redirect = None
+
+    def test_single_instrument_request(self):
+        # XBTUSD の価格と建玉は1回の問い合わせで取得する
+        paths = []
+        def handler(method, path, body):
+            if path.startswith('/www.bitmex.com/api/v1/instrument') :
+                paths.append(path)
+                return 200, 'application/json', json.dumps([{'symbol': 'XBTUSD', 'midPrice': 50000.5, 'openInterest': 123, 'openValue': 456}])
+            return 404, 'application/json', '{}'
+        ProfitGraph.http_redirect = ProfitGraph_bench.stub_server(handler).url
+        db = ProfitGraph.database(logger)
+        rate = ProfitGraph.exchange_rate(logger, db)
+        bitmex = ProfitGraph.bitmex_info(logger, db, rate=rate)
+        deadline = time.time()+5
+        while not (rate.xbtusd and bitmex.open_interest) and time.time() < deadline :
+            time.sleep(0.05)
+        time.sleep(0.2)
+        self.assertEqual((rate.xbtusd, bitmex.open_interest, bitmex.open_value), (50000.5, 123, 456))
+        self.assertEqual(len(paths), 1)
+
+    def test_unknown_rate_source(self):
+        # 既定のレートの取得元を間違えても、既定の取得元で取得する
+        def handler(method, path, body):
+            if path.startswith('/www.bitmex.com/api/v1/instrument') :
+                return 200, 'application/json', json.dumps([{'symbol': 'XBTUSD', 'midPrice': 50000.5}])
+            return 404, 'application/json', '{}'
+        ProfitGraph.http_redirect = ProfitGraph_bench.stub_server(handler).url
+        rate = ProfitGraph.exchange_rate(logger, ProfitGraph.database(logger), rates={'xbtusd': ('bitmx', 'XBTUSD')})
+        deadline = time.time()+5
+        while not rate.xbtusd and time.time() < deadline :
+            time.sleep(0.05)
+        self.assertEqual(rate.xbtusd, 50000.5)
+
+
+
+class max_rss_test(unittest.TestCase):
+    def test_without_resource_module(self):
+        # Windows には resource が無い
+        with mock.patch.dict('sys.modules', {'resource': None}):
+            self.assertIsNone(ProfitGraph._max_rss_mb())
+        self.assertGreater(ProfitGraph._max_rss_mb(), 0)
+
+
+
+class coin_rates_test(unittest.TestCase):
+    def make_exchange(self, coins):
+        adapters = dict(ProfitGraph.exchange.adapters, BYBIT=(lambda items: stub_bybit(), ProfitGraph.exchange.adapters['BYBIT'][1]))
+        with mock.patch.object(ProfitGraph.exchange, 'adapters', adapters):
+            ex = ProfitGraph.exchange(logger, 'bybit1', {'type': 'BYBIT', 'coins': coins}, None, ProfitGraph.database(logger))
+        ex.adapters = adapters
+        return ex
+
+    def test_startup_check(self):
+        exchange_list = {'bybit1': {'type': 'BYBIT', 'coins': ['BTC', 'USDT', 'SOL']}, 'bybit2': {'type': 'BYBIT'}, 'bf1': {'type': 'BF', 'coins': ['XRP']}}
+        errors = ProfitGraph.exchange.check_coin_rates(exchange_list, set(ProfitGraph.exchange_rate.default_rates))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("'solusd'", errors[0])
+
+    def test_skip_until_coin_rate_is_ready(self):
+        # シャードのプロセスでは最初のレートが届くまで _rate が None
+        ex = self.make_exchange(['BTC', 'ETH'])
+        self.assertEqual(ex.write_balance_to_db(None, 0), (0, 0, ""))
+        self.assertEqual(ex.write_balance_to_db(make_snapshot(usdjpy=100, xbtusd=40000), 0), (0, 0, ""))
+        balance, unreal, db_str = ex.write_balance_to_db(make_snapshot(usdjpy=100, xbtusd=40000, ethusd=2000, prices={'ethusd': 2000}), 0)
+        self.assertAlmostEqual(db_str['fixbtc'], 0.5+10*2000/40000)
+
+
+
+class stream_feed_test(unittest.TestCase):
+    def tearDown(self):
+        ProfitGraph.http_redirect = None
+
+    def wait_until(self, condition, timeout=5):
+        deadline = time.time()+timeout
+        while not condition() and time.time() < deadline :
+            time.sleep(0.05)
+        return condition()
+
+    def test_reconnect_and_rest_fallback(self):
+        # ストリーミングの価格は 50000、REST API の価格は 40000
+        stream = ProfitGraph_bench.websocket_stub(lambda path: [{'data': [{'symbol': 'XBTUSD', 'midPrice': 50000}]}] if path=='/bitmex' else [])
+        def handler(method, path, body):
+            if path.startswith('/www.bitmex.com/api/v1/instrument') :
+                return 200, 'application/json', json.dumps([{'symbol': 'XBTUSD', 'midPrice': 40000}])
+            return 404, 'application/json', '{}'
+        ProfitGraph.http_redirect = ProfitGraph_bench.stub_server(handler).url
+
+        with mock.patch.object(ProfitGraph.exchange_rate, '_refresh_interval', 0.5):
+            rate = ProfitGraph.exchange_rate(logger, ProfitGraph.database(logger), streaming=True,
+                                             stream_urls=dict([(name, stream.url+'/'+name) for name in ('bitmex', 'bybit', 'bitflyer')]))
+            self.assertTrue(self.wait_until(lambda: rate.xbtusd==50000))
+
+            # 受信が止まったら REST API で取得する
+            stream.paused = True
+            self.assertTrue(self.wait_until(lambda: rate.xbtusd==40000))
+
+            # 切断されたら再接続して、また受信した価格を使う
+            stream.paused = False
+            stream.disconnect()
+            self.assertTrue(self.wait_until(lambda: stream.connections['/bitmex']>=2 and rate.xbtusd==50000))
+
+
+if __name__ == "__main__":
+    unittest.main()